@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""
+Measure channel messages per second through the brain hook.
+
+The brain pool is replaced with a no-op brain, so this only measures the
+hook's own overhead: nickname matching and queueing lines for learning.
+
+Usage: python bench/brain_hook.py [messages]
+"""
+
+import os
+import random
+import sys
+import time
+
+from contextlib import contextmanager
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from kochira_caa import brain
+
+
+class NoopBrain:
+    def __init__(self):
+        self.graph = SimpleNamespace(commit=lambda: None)
+
+    def learn(self, message):
+        pass
+
+    def reply(self, message, *args, **kwargs):
+        return message
+
+
+class NoopPool:
+    def __init__(self):
+        self.brain = NoopBrain()
+
+    @contextmanager
+    def checkout(self, filename, setup=None):
+        yield self.brain
+
+
+def make_ctx():
+    config = SimpleNamespace(
+        brain_file="brain.db",
+        learn_batch_size=50,
+        learn_flush_interval=5.0,
+        reply_workers=1,
+        reply_budget_ms=500,
+        nickname_aliases=["kochi", "bot"],
+    )
+    return SimpleNamespace(
+        config=config,
+        storage=SimpleNamespace(learn_queues={}, reply_pools={}, matchers={}),
+        client=SimpleNamespace(name="caa", nickname="kochira"),
+        respond=lambda text: None,
+        message=lambda text: None,
+    )
+
+
+def make_messages(n):
+    rng = random.Random(0)
+    words = ["what", "is", "the", "deal", "with", "kedo", "lol", "big", "dog", "today"]
+    messages = []
+    for _ in range(n):
+        message = " ".join(rng.choice(words) for _ in range(rng.randint(3, 20)))
+        roll = rng.random()
+        if roll < 0.05:
+            message = "kochira: " + message
+        elif roll < 0.1:
+            message = message + " kochi"
+        messages.append(message)
+    return messages
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+
+    brain.pool = NoopPool()
+    hook = getattr(brain.reply_and_learn, "__wrapped__", brain.reply_and_learn)
+    ctx = make_ctx()
+    messages = make_messages(n)
+
+    start = time.perf_counter()
+    for message in messages:
+        hook(ctx, "#caa", "someone", message)
+    elapsed = time.perf_counter() - start
+
+    for learn_queue in ctx.storage.learn_queues.values():
+        learn_queue.flush()
+
+    print("{} messages in {:.3f}s: {:.0f} messages/s".format(n, elapsed, n / elapsed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""
+Compare the per-reply brain scorers against BatchScorer.
+
+Usage: python bench/brain_scoring.py [candidates] [rounds]
+"""
+
+import itertools
+import operator
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from cobe.scoring import LengthScorer, Scorer
+
+from kochira_caa.brain import BatchScorer
+
+
+# the scorers BatchScorer replaced, kept as a reference implementation
+
+class BalancedScorer(Scorer):
+    def score(self, reply):
+        text = reply.to_text()
+        quotes = sum([1 for x in text if x == '"'])
+        return 0.5 if quotes % 2 else 1.0
+
+
+class RepeatedMentionScorer(Scorer):
+    def score(self, reply):
+        words = reply.to_text().split()
+        at_mentions = [1 if word.startswith('@') else 0 for word in words]
+        run_lengths = [
+            len(list(y))
+            for (x, y)
+            in itertools.groupby(
+                (enumerate(at_mentions)),
+                operator.itemgetter(1)
+            )
+            if x
+        ]
+        if not run_lengths:
+            return 1.0
+
+        return 1.0 / max(1.0, max(run_lengths) - 1)
+
+
+WORDS = ["the", "dog", "is", '"big"', "@kedo", "@szi", "what", '"no', "yes\"", "lol"]
+
+
+class FakeReply:
+    def __init__(self, words):
+        self.text = " ".join(words)
+        self.edge_ids = tuple(range(len(words) + 1))
+
+    def to_text(self):
+        return self.text
+
+
+def make_replies(n):
+    rng = random.Random(0)
+    return [FakeReply([rng.choice(WORDS) for _ in range(rng.randint(3, 30))])
+            for _ in range(n)]
+
+
+def per_reply(scorers, replies):
+    return [sum(scorer.score(reply) for scorer in scorers) / len(scorers)
+            for reply in replies]
+
+
+def main():
+    candidates = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+
+    replies = make_replies(candidates)
+    scorers = [LengthScorer(), BalancedScorer(), RepeatedMentionScorer()]
+    batch = BatchScorer()
+
+    assert all(abs(a - b) < 1e-9 for a, b in
+               zip(per_reply(scorers, replies), batch.score_batch(replies)))
+    assert all(abs(a - batch.score(r)) < 1e-9 for a, r in
+               zip(per_reply(scorers, replies), replies))
+
+    old = min(timeit.repeat(lambda: per_reply(scorers, replies), number=rounds, repeat=3))
+    new = min(timeit.repeat(lambda: batch.score_batch(replies), number=rounds, repeat=3))
+    # cobe's reply loop scores each candidate as it's generated, which is how
+    # the batch scorer is called in production
+    single = min(timeit.repeat(lambda: [batch.score(r) for r in replies], number=rounds, repeat=3))
+
+    print("{} candidates x {} rounds".format(candidates, rounds))
+    print("per-reply scorers: {:8.2f} us/candidate".format(old / rounds / candidates * 1e6))
+    print("batch scorer:      {:8.2f} us/candidate".format(new / rounds / candidates * 1e6))
+    print("batch scorer, one: {:8.2f} us/candidate".format(single / rounds / candidates * 1e6))
+    print("speedup:           {:8.2f}x batched, {:.2f}x one at a time".format(old / new, old / single))
+
+
+if __name__ == "__main__":
+    main()
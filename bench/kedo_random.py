@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+Compare ORDER BY RANDOM() kedo lookups against the in-memory KedoTome.
+
+Builds an in-memory database of synthetic bits with a skewed topic
+distribution, then times random lookups on popular topics both ways: with
+ORDER BY RANDOM() against the database, and with KedoTome.get plus
+random.choice, which is what !kedo does.
+
+Usage: python bench/kedo_random.py [bits] [lookups]
+"""
+
+import os
+import random
+import sys
+import time
+
+from peewee import CharField, Model, SqliteDatabase, fn
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from kochira_caa.kedo import KedoTome
+
+database = SqliteDatabase(":memory:")
+
+
+class KedoBit(Model):
+    topic = CharField(255)
+    knowledge = CharField(450)
+
+    class Meta:
+        database = database
+        indexes = (
+            (("topic",), False),
+        )
+
+
+def populate(n):
+    rng = random.Random(0)
+    topics = ["topic{}".format(i) for i in range(1000)]
+    rows = [{"topic": topics[min(int(rng.paretovariate(1.2)) - 1, 999)],
+             "knowledge": "bit {} ".format(i) * 8}
+            for i in range(n)]
+
+    with database.atomic():
+        for i in range(0, n, 400):
+            KedoBit.insert_many(rows[i:i + 400]).execute()
+
+    return [topic for topic, _ in
+            KedoBit.select(KedoBit.topic, fn.COUNT(KedoBit.id).alias("count"))
+                   .group_by(KedoBit.topic)
+                   .order_by(fn.COUNT(KedoBit.id).desc())
+                   .limit(20)
+                   .tuples()]
+
+
+def order_by_random(topic):
+    if not KedoBit.select().where(KedoBit.topic == topic).exists():
+        return None
+    return KedoBit.select().where(KedoBit.topic == topic).order_by(fn.Random()).limit(1)[0]
+
+
+def load_tome():
+    # the same query KedoTome.load runs, against this benchmark's database
+    tome = KedoTome()
+    tome.learn_many(KedoBit.select(KedoBit.topic, KedoBit.knowledge).order_by(KedoBit.id).tuples())
+    return tome
+
+
+def from_tome(tome, topic):
+    bits = tome.get(topic)
+    if not bits:
+        return None
+    return random.choice(bits)
+
+
+def timed(f, topics):
+    start = time.perf_counter()
+    for topic in topics:
+        f(topic)
+    return (time.perf_counter() - start) / len(topics)
+
+
+def main():
+    bits = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    lookups = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+
+    database.connect()
+    KedoBit.create_table(True)
+    popular = populate(bits)
+    topics = [random.choice(popular) for _ in range(lookups)]
+
+    start = time.perf_counter()
+    tome = load_tome()
+    load_ms = (time.perf_counter() - start) * 1000
+
+    old = timed(order_by_random, topics)
+    new = timed(lambda topic: from_tome(tome, topic), topics)
+
+    print("{} bits, {} lookups over the 20 most popular topics".format(bits, lookups))
+    print("largest topic: {} bits".format(len(tome.topics[popular[0]])))
+    print("loading the tome:         {:8.1f} ms".format(load_ms))
+    print("ORDER BY RANDOM():        {:8.1f} us/lookup".format(old * 1e6))
+    print("KedoTome.get + choice:    {:8.1f} us/lookup".format(new * 1e6))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""
+Compare loading a pasta model from JSON against a compiled chain.
+
+Each format is loaded in a fresh interpreter, which reports the load time
+and how much the load grew its peak RSS.
+
+Usage: python bench/pasta_load.py pasta_model.json pasta_model.chain
+"""
+
+import os
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+LOADERS = {
+    "json": """
+with open(path, 'r') as f:
+    chain = Chain.from_json(f.read())
+""",
+    "compiled": """
+chain = CompiledChain(path)
+""",
+}
+
+TEMPLATE = """
+import resource, sys, time
+sys.path.insert(0, {root!r})
+from markovify import Chain
+from kochira_caa.pasta_chain import CompiledChain
+
+path = {path!r}
+before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+start = time.perf_counter()
+{loader}
+elapsed = time.perf_counter() - start
+chain.walk()
+after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(elapsed, after - before)
+"""
+
+
+def measure(kind, path):
+    code = TEMPLATE.format(root=ROOT, path=path, loader=LOADERS[kind])
+    out = subprocess.run([sys.executable, "-c", code], check=True,
+                         stdout=subprocess.PIPE, universal_newlines=True).stdout
+    elapsed, rss = out.split()
+    return float(elapsed), int(rss)
+
+
+def main():
+    json_path, compiled_path = sys.argv[1:3]
+
+    for kind, path in (("json", json_path), ("compiled", compiled_path)):
+        elapsed, rss = measure(kind, path)
+        print("{:8s} load: {:8.2f} ms  peak RSS growth: {:8d} KiB  ({} bytes on disk)".format(
+            kind, elapsed * 1000, rss, os.path.getsize(path)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+Report what each service costs when the bot starts.
+
+Every service module is imported in a fresh interpreter. The import time,
+the run time of its setup functions and the heavy dependencies that were
+loaded are reported.
+
+Setup functions are recorded by wrapping Service.setup, then run against a
+throwaway context whose config is the service's config class with no
+values set. Setups that need a running bot fail, and that is reported
+instead of a time.
+
+Usage: python bench/startup.py [service ...]
+"""
+
+import os
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+SERVICES = [
+    "brain", "gemma", "imouto", "kedo", "london", "metar", "moffle", "natto",
+    "pasta", "prongramin", "qc", "radio", "slack", "sux", "thinking_face",
+    "wordnik", "yelp",
+]
+
+HEAVY = ["nltk", "google.genai", "lxml.etree", "cobe.brain", "markovify", "peewee", "tornado.web"]
+
+TEMPLATE = """
+import importlib, sys, time
+from types import SimpleNamespace
+sys.path.insert(0, {root!r})
+
+from kochira.service import Service
+
+setups = []
+configs = []
+original_setup = Service.setup
+original_config = Service.config
+
+def record_setup(self, f):
+    setups.append(f)
+    return original_setup(self, f)
+
+def record_config(self, c):
+    configs.append(c)
+    return original_config(self, c)
+
+Service.setup = record_setup
+Service.config = record_config
+
+start = time.perf_counter()
+importlib.import_module("kochira_caa.{name}")
+imported = time.perf_counter() - start
+
+setup = 0.0
+try:
+    config = configs[0]({{}}) if configs else None
+    for setup_func in setups:
+        ctx = SimpleNamespace(config=config, storage=SimpleNamespace(), bot=None)
+        start = time.perf_counter()
+        setup_func(ctx)
+        setup += time.perf_counter() - start
+except Exception as e:
+    setup = "failed ({{}})".format(type(e).__name__)
+
+heavy = [name for name in {heavy!r} if name in sys.modules]
+print(repr((imported, setup, heavy)))
+"""
+
+
+def measure(name):
+    code = TEMPLATE.format(root=ROOT, name=name, heavy=HEAVY)
+    result = subprocess.run([sys.executable, "-c", code], stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE, universal_newlines=True)
+    if result.returncode:
+        return None, result.stderr.strip().splitlines()[-1]
+    return eval(result.stdout), None
+
+
+def main():
+    services = sys.argv[1:] or SERVICES
+    total = 0.0
+
+    for name in services:
+        result, error = measure(name)
+        if error:
+            print("{:14s} import failed: {}".format(name, error))
+            continue
+
+        imported, setup, heavy = result
+        total += imported
+        setup = "{:7.1f} ms".format(setup * 1000) if isinstance(setup, float) else setup
+        print("{:14s} import: {:7.1f} ms  setup: {}  heavy: {}".format(
+            name, imported * 1000, setup, ", ".join(heavy) or "-"))
+
+    print("total import time: {:.1f} ms".format(total * 1000))
+
+
+if __name__ == "__main__":
+    main()
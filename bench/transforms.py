@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+Time the text transforms on a 10 KB wall of text.
+
+The character-at-a-time implementations the commands used to have are
+timed alongside for comparison.
+
+Usage: python bench/transforms.py [bytes] [rounds]
+"""
+
+import os
+import random
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from kochira_caa import transforms
+
+
+def old_nichi(text):
+    new_text = ''
+    for c in text:
+        if random.random() < 0.4:
+            if random.random() < 0.3:
+                new_text += ',' * random.randint(3, 6)
+            else:
+                new_text += ',' * random.randint(1, 2)
+        new_text += c
+    return new_text
+
+
+def old_spongebob(text):
+    new_text = ''
+    run_length = 1
+    current_transform = str.upper if random.random() < 0.5 else str.lower
+    for c in text:
+        new_text += current_transform(c)
+
+        if random.random() > 0.75 ** (run_length * 1.5):
+            current_transform = str.upper if current_transform is str.lower else str.lower
+            run_length = 1
+        else:
+            run_length += 1
+    return new_text
+
+
+def old_imouto(text, imouto):
+    from nltk.stem.snowball import SnowballStemmer
+    stemmer = SnowballStemmer('english')
+
+    def stemmed_imouto(match):
+        word = match.group(0)
+        word_stem = stemmer.stem(word)
+        if word != word_stem and word.startswith(word_stem):
+            return transforms.case_corrected_imouto(word, imouto) + word[len(word_stem):]
+        else:
+            return transforms.case_corrected_imouto(word, imouto)
+    return re.sub(r"\w\w\w\w\w+", stemmed_imouto, text)
+
+
+def make_text(size):
+    rng = random.Random(0)
+    words = ["Recreational", "drugs", "and", "heavy", "alcohol", "consumption", "have",
+             "been", "normal", "among", "young", "people", "the", "last", "half", "century"]
+    text = ""
+    while len(text) < size:
+        text += rng.choice(words) + " "
+    return text[:size]
+
+
+def main():
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 10 * 1024
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    text = make_text(size)
+
+    cases = [
+        ("nichi", old_nichi, transforms.nichi),
+        ("spongebob", old_spongebob, transforms.spongebob),
+        ("imouto", lambda t: old_imouto(t, "imouto"), lambda t: transforms.imouto(t, "imouto")),
+    ]
+
+    print("{} bytes x {} rounds".format(size, rounds))
+    for name, old, new in cases:
+        try:
+            old_time = min(timeit.repeat(lambda: old(text), number=rounds, repeat=3)) / rounds
+            new_time = min(timeit.repeat(lambda: new(text), number=rounds, repeat=3)) / rounds
+        except ImportError as e:
+            print("{:10s} skipped: {}".format(name, e))
+            continue
+
+        print("{:10s} old: {:8.2f} ms  new: {:8.2f} ms  speedup: {:5.2f}x".format(
+            name, old_time * 1000, new_time * 1000, old_time / new_time))
+
+
+if __name__ == "__main__":
+    main()
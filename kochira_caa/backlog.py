@@ -0,0 +1,113 @@
+"""
+Channel backlog helpers.
+
+Shared by the commands that work on the previous line, and by services that
+need a formatted transcript of recent messages.
+"""
+
+from collections import deque
+from itertools import islice
+
+def previous_line(ctx):
+    """
+    Return the (origin, message) before the one being handled, or None if
+    there isn't one.
+    """
+    backlog = ctx.client.backlogs.get(ctx.target)
+    if backlog is None or len(backlog) < 2:
+        return None
+    return backlog[1]
+
+def format_line(origin, message, nickname, name):
+    return "<{}> {}".format(origin if origin != nickname else name, message)
+
+class Transcript:
+    """
+    Formatted transcript of a channel's backlog.
+
+    Kochira's backlogs hold the newest message first. The transcript keeps
+    the last ``window`` of them oldest first, and only formats the messages
+    that arrived since it was last synced. Transcripts are formatted
+    separately for each name the bot's own lines are attributed to.
+    """
+
+    def __init__(self, window=None):
+        self.window = window
+        self.lines = deque(maxlen=window)
+        self.newest = None
+
+        self.formatted = {}
+        self.texts = {}
+
+    def sync(self, backlog):
+        new = []
+        for entry in backlog:
+            if entry is self.newest:
+                break
+            new.append(entry)
+        else:
+            # we've lost track of where we were, so start over
+            self.lines.clear()
+            self.formatted.clear()
+
+        if not new:
+            return
+
+        self.newest = new[0]
+        new.reverse()
+        self.lines.extend(new)
+
+        for (nickname, name), formatted in self.formatted.items():
+            formatted.extend(format_line(origin, message, nickname, name)
+                             for origin, message in new)
+        self.texts.clear()
+
+    def text(self, nickname, name, budget=None, cost=len):
+        """
+        Return the transcript of the lines before the newest one, with the
+        bot's lines attributed to ``name``.
+
+        If a budget is given, only as many of the most recent lines as fit in
+        it are included, where each line costs ``cost(line)``.
+        """
+        key = (nickname, name, budget)
+
+        if key not in self.texts:
+            if (nickname, name) not in self.formatted:
+                self.formatted[nickname, name] = deque(
+                    (format_line(origin, message, nickname, name) for origin, message in self.lines),
+                    maxlen=self.window)
+
+            formatted = self.formatted[nickname, name]
+            count = len(formatted) - 1
+
+            if budget is not None:
+                spent = 0
+                for i, line in enumerate(islice(reversed(formatted), 1, None)):
+                    spent += cost(line)
+                    if spent > budget:
+                        count = i
+                        break
+
+            self.texts[key] = "\n".join(islice(formatted, len(formatted) - 1 - count, len(formatted) - 1))
+
+        return self.texts[key]
+
+def get_transcript(ctx, transcripts, window=None):
+    """
+    Return the synced transcript for the current channel, keeping it in the
+    ``transcripts`` dict. Without a window, the transcript holds as many lines
+    as the channel's backlog does.
+    """
+    key = (ctx.client.name, ctx.target)
+    backlog = ctx.client.backlogs.get(ctx.target, ())
+
+    if window is None:
+        window = getattr(backlog, "maxlen", None)
+
+    transcript = transcripts.get(key)
+    if transcript is None or transcript.window != window:
+        transcript = transcripts[key] = Transcript(window)
+
+    transcript.sync(backlog)
+    return transcript
@@ -4,20 +4,31 @@ Artificial (un)intelligence.
 Allows the bot to reply whenever its nickname is mentioned.
 """
 
-import itertools
 import operator
+import queue
 import re
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor, wait
 
 from kochira import config
 from kochira.service import Service, background, Config
-from cobe.brain import Brain
-from cobe.scoring import Scorer, ScorerGroup, LengthScorer
+
+from .brainpool import open_brain, pool
+from cobe.scoring import Scorer, ScorerGroup
 
 service = Service(__name__, __doc__)
 
 @service.config
 class Config(Config):
     brain_file = config.Field(doc="Location to store the brain in.", default="brain.db")
+    learn_batch_size = config.Field(doc="Number of queued lines that triggers a learning flush.", default=50)
+    learn_flush_interval = config.Field(doc="Maximum number of seconds a line waits in the learning queue.", default=5.0)
+    reply_budget_ms = config.Field(doc="Time budget for generating a reply, in milliseconds.", default=500)
+    reply_workers = config.Field(doc="Number of read-only brain connections generating reply candidates in parallel.", default=1)
+    max_open_brains = config.Field(doc="Maximum number of brains kept open at once.", default=8)
+    nickname_aliases = config.Field(doc="Other names the bot should reply to.", type=config.Many(str), default=[])
 
 # cobe's ScorerGroup.score has a bug, so rather than address the problem
 # directly, let's monkeypatch it.
@@ -37,76 +48,299 @@ def scorergroup_score(self, reply):
 
     return score / self.total_weight
 
-class BalancedScorer(Scorer):
-    def score(self, reply):
-        text = reply.to_text()
-        quotes = sum([1 for x in text if x == '"'])
-        return 0.5 if quotes % 2 else 1.0
+# cobe only hands back the text of its best reply, so remember the score it
+# had when it gets reported back to the scorers. This lets us compare the
+# winners of several replicas against each other.
+def scorergroup_end(self, reply):
+    self.best_score = self.score(reply)
+    ScorerGroup.end(self, reply)
+
+class BatchScorer(Scorer):
+    """
+    Combined length, quote balance and @-mention scorer.
+
+    Each reply's text is rendered and split once, and all three scores are
+    computed from that in a single pass. Equivalent to cobe's LengthScorer
+    and the quote and mention scorers it replaced (see
+    bench/brain_scoring.py) with equal weights.
+    """
+
+    def score_batch(self, replies):
+        scores = []
+
+        for reply in replies:
+            text = reply.to_text()
+
+            longest_run = 0
+            run = 0
+            for word in text.split():
+                if word.startswith('@'):
+                    run += 1
+                    if run > longest_run:
+                        longest_run = run
+                else:
+                    run = 0
+
+            length = self.normalize(len(reply.edge_ids))
+            balanced = 0.5 if text.count('"') % 2 else 1.0
+            mentions = 1.0 / max(1.0, longest_run - 1) if longest_run else 1.0
+
+            scores.append((length + balanced + mentions) / 3)
+
+        return scores
 
-class RepeatedMentionScorer(Scorer):
     def score(self, reply):
-        words = reply.to_text().split()
-        at_mentions = [1 if word.startswith('@') else 0 for word in words]
-        run_lengths = [
-            len(list(y))
-            for (x, y)
-            in itertools.groupby(
-                (enumerate(at_mentions)),
-                operator.itemgetter(1)
-            )
-            if x
-        ]
-        if not run_lengths:
-            return 1.0
+        return self.score_batch([reply])[0]
+
+class LearnQueue:
+    """
+    Write-behind learning queue for a brain.
 
-        return 1.0 / max(1.0, max(run_lengths) - 1)
+    Lines are coalesced and learned in a single transaction once either
+    ``batch_size`` lines are pending or the oldest pending line has waited
+    ``flush_interval`` seconds.
+    """
 
-def load_brain(ctx):
-    ctx.storage.brains[ctx.config.brain_file] = Brain(ctx.config.brain_file, check_same_thread=False)
+    def __init__(self, brain_file, batch_size, flush_interval):
+        self.brain_file = brain_file
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        self.pending = []
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.timer = None
+
+        self.max_depth = 0
+        self.flushes = 0
+        self.lines_learned = 0
+        self.last_flush_ms = 0.0
+        self.total_flush_ms = 0.0
+
+    @property
+    def depth(self):
+        return len(self.pending)
+
+    def put(self, message):
+        with self.lock:
+            self.pending.append(message)
+            self.max_depth = max(self.max_depth, len(self.pending))
+
+            if len(self.pending) < self.batch_size:
+                if self.timer is None:
+                    self.timer = threading.Timer(self.flush_interval, self.flush)
+                    self.timer.daemon = True
+                    self.timer.start()
+                return
+
+        self.flush()
+
+    def flush(self):
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            messages, self.pending = self.pending, []
+
+        if not messages:
+            return
+
+        with self.flush_lock, pool.checkout(self.brain_file, setup_brain) as brain:
+            start = time.monotonic()
+
+            # cobe only commits after each line if it isn't batch learning.
+            # start_batch_learning also drops the reply indexes, which is far
+            # too expensive for a handful of lines, so flip the flag directly.
+            brain._learning = True
+            try:
+                for message in messages:
+                    brain.learn(message)
+            finally:
+                brain._learning = False
+                brain.graph.commit()
+
+            elapsed = (time.monotonic() - start) * 1000
+
+        self.flushes += 1
+        self.lines_learned += len(messages)
+        self.last_flush_ms = elapsed
+        self.total_flush_ms += elapsed
+
+# how long past the budget a reply may take before its candidates are given up on
+REPLY_SLACK_MS = 250
+
+class ReplyPool:
+    """
+    Generates replies within a latency budget.
+
+    With more than one worker, each worker runs cobe's reply loop for the
+    whole budget against its own read-only connection to the brain, and the
+    best-scored of their replies wins. Candidates not ready by the deadline
+    are dropped, and if none are, the reply comes from the brain itself.
+    """
+
+    def __init__(self, brain_file, workers, loop_ms):
+        self.brain_file = brain_file
+        self.workers = workers
+        self.loop_ms = loop_ms
+
+        self.replicas = queue.Queue()
+        self.replicas_open = False
+        self.lock = threading.Lock()
+        self.executor = None
+
+        if workers > 1:
+            self.executor = ThreadPoolExecutor(max_workers=workers)
+
+    def _open_replicas(self):
+        with self.lock:
+            if self.replicas_open:
+                return
 
-    scorer = ctx.storage.brains[ctx.config.brain_file].scorer
+            for _ in range(self.workers):
+                replica = open_brain(self.brain_file)
+                setup_brain(replica)
+                replica.graph.cursor().execute("PRAGMA query_only = ON")
+                self.replicas.put(replica)
+            self.replicas_open = True
+
+    def _candidate(self, message):
+        replica = self.replicas.get()
+        try:
+            # cobe doesn't end scoring when it has nothing to say, so don't
+            # let that reply inherit the score of the last one
+            replica.scorer.best_score = -1.0
+            text = replica.reply(message, loop_ms=self.loop_ms)
+            return replica.scorer.best_score, text
+        finally:
+            self.replicas.put(replica)
+
+    def reply(self, brain, message):
+        if self.executor is None:
+            return brain.reply(message, loop_ms=self.loop_ms)
+
+        self._open_replicas()
+        futures = [self.executor.submit(self._candidate, message)
+                   for _ in range(self.workers)]
+
+        # with other replies ahead of this one the replicas may all be busy,
+        # so don't wait on them any longer than a reply should take
+        done, not_done = wait(futures, timeout=(self.loop_ms + REPLY_SLACK_MS) / 1000)
+        for future in not_done:
+            future.cancel()
+
+        if not done:
+            return brain.reply(message, loop_ms=self.loop_ms)
+
+        _, text = max((future.result() for future in done),
+                      key=operator.itemgetter(0))
+        return text
+
+    def close_replicas(self):
+        with self.lock:
+            while not self.replicas.empty():
+                self.replicas.get().graph.close()
+            self.replicas_open = False
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+        self.close_replicas()
+
+def setup_brain(brain):
+    scorer = brain.scorer
     scorer.score = scorergroup_score.__get__(scorer, ScorerGroup)
-    scorer.add_scorer(1.0, LengthScorer())
-    scorer.add_scorer(1.0, BalancedScorer())
-    scorer.add_scorer(1.0, RepeatedMentionScorer())
+    scorer.end = scorergroup_end.__get__(scorer, ScorerGroup)
+    scorer.best_score = 0.0
+    scorer.add_scorer(3.0, BatchScorer())
+
+class NicknameMatcher:
+    """
+    Compiled matchers for the bot's nickname and its aliases.
+    """
+
+    def __init__(self, nickname, aliases):
+        self.nickname = nickname
+        self.aliases = aliases
+
+        names = "|".join(re.escape(name) for name in
+                         sorted({nickname, *aliases}, key=len, reverse=True))
+        self.address_re = re.compile(r"[,:]*(?:{})[,:]*(?: |$)".format(names), re.I)
+        self.mention_re = re.compile(r"\b(?:{})\b".format(names), re.I)
+
+    def match(self, message):
+        """
+        Return whether the message addresses the bot, whether it should
+        reply, and the message with any address stripped.
+        """
+        address = self.address_re.match(message)
+        if address is not None:
+            return True, True, message[address.end():].strip()
+
+        message = message.strip()
+        return False, self.mention_re.search(message) is not None, message
+
+def get_matcher(ctx):
+    nickname = ctx.client.nickname
+    aliases = tuple(ctx.config.nickname_aliases)
+
+    matcher = ctx.storage.matchers.get(ctx.client.name)
+    if matcher is None or matcher.nickname != nickname or matcher.aliases != aliases:
+        matcher = NicknameMatcher(nickname, aliases)
+        ctx.storage.matchers[ctx.client.name] = matcher
+
+    return matcher
+
+def load_brain(ctx):
+    brain_file = ctx.config.brain_file
+
+    if brain_file not in ctx.storage.learn_queues:
+        ctx.storage.learn_queues[brain_file] = LearnQueue(
+            brain_file, ctx.config.learn_batch_size, ctx.config.learn_flush_interval)
+        ctx.storage.reply_pools[brain_file] = ReplyPool(
+            brain_file, ctx.config.reply_workers, ctx.config.reply_budget_ms)
+
+    return ctx.storage.learn_queues[brain_file], ctx.storage.reply_pools[brain_file]
 
 @service.setup
 def load_default_brain(ctx):
-    ctx.storage.brains = {}
+    ctx.storage.learn_queues = {}
+    ctx.storage.reply_pools = {}
+    ctx.storage.matchers = {}
+    ctx.storage.default_brain_file = ctx.config.brain_file
     load_brain(ctx)
-    ctx.storage.brain = ctx.storage.brains[ctx.config.brain_file]
+
+    # replica connections of evicted brains are closed along with them
+    def close_replicas(brain_file):
+        if brain_file in ctx.storage.reply_pools:
+            ctx.storage.reply_pools[brain_file].close_replicas()
+
+    ctx.storage.close_replicas = close_replicas
+    pool.max_open = ctx.config.max_open_brains
+    pool.add_close_listener(close_replicas)
 
 @service.shutdown
 def unload_brain(ctx):
-    for brain in ctx.storage.brains.values():
-        brain.graph.close()
+    for learn_queue in ctx.storage.learn_queues.values():
+        learn_queue.flush()
+
+    pool.remove_close_listener(ctx.storage.close_replicas)
+
+    for reply_pool in ctx.storage.reply_pools.values():
+        reply_pool.shutdown()
 
-def get_brain(ctx):
-    if ctx.config.brain_file not in ctx.storage.brains:
-        load_brain(ctx)
-    return ctx.storage.brains[ctx.config.brain_file]
+    for brain_file in ctx.storage.learn_queues:
+        pool.close(brain_file)
 
 @service.hook("channel_message", priority=-9999)
 @background
 def reply_and_learn(ctx, target, origin, message):
-    front, _, rest = message.partition(" ")
-
-    mention = False
-    reply = False
-
-    if front.strip(",:").lower() == ctx.client.nickname.lower():
-        mention = True
-        reply = True
-        message = rest
-
-    message = message.strip()
-    brain = get_brain(ctx)
-
-    if re.search(r"\b{}\b".format(re.escape(ctx.client.nickname)), message, re.I) is not None:
-        reply = True
+    mention, reply, message = get_matcher(ctx).match(message)
+    learn_queue, reply_pool = load_brain(ctx)
 
     if reply:
-        reply_message = brain.reply(message)
+        with pool.checkout(ctx.config.brain_file, setup_brain) as brain:
+            reply_message = reply_pool.reply(brain, message)
 
         if mention:
             ctx.respond(reply_message)
@@ -114,14 +348,47 @@ def reply_and_learn(ctx, target, origin, message):
             ctx.message(reply_message)
 
     if message:
-        brain.learn(message)
+        learn_queue.put(message)
+
+@service.command(r"!brainstats$")
+def brain_stats(ctx):
+    """
+    Brain stats.
+
+    Show the state of the brain pool and learning queues.
+    """
+    ctx.message(
+        "\x02brain pool:\x02 open: {open}/{p.max_open}, hits: {p.hits}, "
+        "misses: {p.misses}, evictions: {p.evictions}".format(
+            open=len(pool.brains),
+            p=pool,
+        )
+    )
+
+    for brain_file, learn_queue in ctx.storage.learn_queues.items():
+        ctx.message(
+            "\x02{brain_file}:\x02 depth: {q.depth}, max depth: {q.max_depth}, "
+            "flushes: {q.flushes}, lines learned: {q.lines_learned}, "
+            "last flush: {q.last_flush_ms:.1f}ms, avg flush: {avg:.1f}ms".format(
+                brain_file=brain_file,
+                q=learn_queue,
+                avg=learn_queue.total_flush_ms / learn_queue.flushes if learn_queue.flushes else 0.0,
+            )
+        )
 
 @service.provides("brain")
 def reply(ctx, message, *args, **kwargs):
     """
     Reply to a message with the default brain.
 
-    Passes any additional arguments to the brain's .reply function.
+    Passes any additional arguments to the brain's .reply function. Without
+    any, the reply is generated within the configured latency budget.
     """
-    return service.binding_for(ctx.bot).storage.brain.reply(message, *args, **kwargs)
+    storage = service.binding_for(ctx.bot).storage
+    brain_file = storage.default_brain_file
+
+    with pool.checkout(brain_file, setup_brain) as brain:
+        if args or kwargs:
+            return brain.reply(message, *args, **kwargs)
+        return storage.reply_pools[brain_file].reply(brain, message)
 
@@ -0,0 +1,152 @@
+"""
+Shared registry of open cobe brains.
+
+Services check brains out of the shared pool instead of opening them
+directly, so the number of open brain databases stays bounded no matter how
+many brain files are configured.
+"""
+
+import logging
+import re
+import sqlite3
+import threading
+
+from collections import OrderedDict
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+PRAGMAS = [
+    ("journal_mode", "WAL"),
+    ("mmap_size", 256 * 1024 * 1024),
+    ("cache_size", -16 * 1024),
+]
+
+JOURNAL_MODE_RE = re.compile(r"\s*PRAGMA\s+journal_mode\s*=\s*(\w+)", re.I)
+
+class BrainCursor(sqlite3.Cursor):
+    def execute(self, sql, *args):
+        # cobe sets its own journal mode every time it opens a brain, and
+        # leaving WAL fails while any other connection has the brain open
+        match = JOURNAL_MODE_RE.match(sql)
+        if match is not None and match.group(1).lower() != "wal":
+            return super().execute("PRAGMA journal_mode")
+        return super().execute(sql, *args)
+
+class BrainConnection(sqlite3.Connection):
+    def cursor(self, factory=BrainCursor):
+        return super().cursor(factory)
+
+def open_brain(filename):
+    """
+    Open a brain outside of the pool, with the shared pragmas applied.
+    """
+    from cobe.brain import Brain
+
+    brain = Brain(filename, check_same_thread=False, factory=BrainConnection)
+
+    # cobe leaves a transaction open after initializing a new brain, and the
+    # journal mode can't be changed inside one
+    brain.graph.commit()
+
+    cursor = brain.graph.cursor()
+    for pragma, value in PRAGMAS:
+        # read every row so the statement doesn't hold a read open
+        rows = cursor.execute("PRAGMA {} = {}".format(pragma, value)).fetchall()
+
+        if pragma == "journal_mode" and (not rows or rows[0][0].lower() != value.lower()):
+            logger.warning("Couldn't switch %s to %s journaling, it's using %s",
+                           filename, value, rows[0][0] if rows else "an unknown mode")
+    cursor.close()
+
+    return brain
+
+class BrainPool:
+    """
+    LRU of open brains keyed by filename.
+
+    Once more than ``max_open`` brains are open, the least recently used ones
+    that aren't checked out are closed. Close listeners are called with the
+    filename before a brain is closed.
+    """
+
+    def __init__(self, max_open=8):
+        self.max_open = max_open
+
+        self.brains = OrderedDict()
+        self.checkouts = {}
+        self.close_listeners = []
+        self.lock = threading.RLock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, filename, setup=None):
+        with self.lock:
+            if filename in self.brains:
+                self.hits += 1
+                self.brains.move_to_end(filename)
+                return self.brains[filename]
+
+            self.misses += 1
+            brain = open_brain(filename)
+            if setup is not None:
+                setup(brain)
+
+            self.brains[filename] = brain
+            self._evict(keep=filename)
+            return brain
+
+    @contextmanager
+    def checkout(self, filename, setup=None):
+        """
+        Use a brain, making sure it isn't evicted in the meantime.
+        """
+        with self.lock:
+            brain = self.get(filename, setup)
+            self.checkouts[filename] = self.checkouts.get(filename, 0) + 1
+
+        try:
+            yield brain
+        finally:
+            with self.lock:
+                self.checkouts[filename] -= 1
+                if not self.checkouts[filename]:
+                    del self.checkouts[filename]
+                self._evict()
+
+    def _evict(self, keep=None):
+        for filename in list(self.brains):
+            if len(self.brains) <= self.max_open:
+                break
+
+            if filename == keep or filename in self.checkouts:
+                continue
+
+            self.evictions += 1
+            self.close(filename)
+
+    def close(self, filename):
+        with self.lock:
+            brain = self.brains.pop(filename, None)
+            if brain is None:
+                return
+
+            for listener in self.close_listeners:
+                listener(filename)
+
+            brain.graph.close()
+
+    def close_all(self):
+        with self.lock:
+            for filename in list(self.brains):
+                self.close(filename)
+
+    def add_close_listener(self, listener):
+        self.close_listeners.append(listener)
+
+    def remove_close_listener(self, listener):
+        self.close_listeners.remove(listener)
+
+pool = BrainPool()
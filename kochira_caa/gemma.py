@@ -4,24 +4,414 @@ Ask Gemma Nye anything.
 Allows the bot to query the Gemini API to generate text.
 """
 
+import asyncio
+import hashlib
+import re
 import textwrap
+import threading
+import time
+from collections import OrderedDict
 from datetime import date
-from typing import NamedTuple
+from functools import lru_cache
 
-from google import genai
-from google.genai import errors, types
+from peewee import CharField, DateField, IntegerField
 
 from kochira import config
+from kochira.db import Model
 from kochira.service import Service, Config
 
+from .backlog import get_transcript
 
-class QuotaState(NamedTuple):
-    for_date: date
-    tokens_used: int
 
-    @staticmethod
-    def zero():
-        return QuotaState(date.today(), 0)
+class GemmaTokenUsage(Model):
+    for_date = DateField()
+    network = CharField(255)
+    channel = CharField(255)
+    user = CharField(255)
+    tokens = IntegerField(default=0)
+
+    class Meta:
+        indexes = (
+            (("for_date", "network", "channel", "user"), True),
+        )
+
+
+class QuotaLedger:
+    """
+    Daily token usage, broken down by network, channel and user.
+
+    Usage is counted in memory under a lock and written to the database in
+    batches from a timer thread, once either ``batch_size`` records are
+    pending or the oldest has waited ``flush_interval`` seconds. Requests
+    reserve their estimated cost up front, so concurrent requests can't all
+    squeeze in under the quota at once.
+    """
+
+    def __init__(self, quota, batch_size, flush_interval):
+        self.quota = quota
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.timer = None
+
+        self.for_date = date.today()
+        self.tokens_used = 0
+        self.reserved = 0
+        self.usage = {}
+        self.pending = {}
+        self.pending_records = 0
+
+        self.rejected = 0
+        self.flushes = 0
+
+    def load(self):
+        usage = {}
+        for network, channel, user, tokens in (GemmaTokenUsage
+                .select(GemmaTokenUsage.network, GemmaTokenUsage.channel, GemmaTokenUsage.user, GemmaTokenUsage.tokens)
+                .where(GemmaTokenUsage.for_date == date.today())
+                .tuples()):
+            usage[network, channel, user] = tokens
+
+        with self.lock:
+            self.for_date = date.today()
+            self.usage = usage
+            self.tokens_used = sum(usage.values())
+
+    def _roll_over(self):
+        # pending usage is keyed by date, so yesterday's still gets flushed
+        # to the right row
+        if self.for_date != date.today():
+            self.for_date = date.today()
+            self.usage = {}
+            self.tokens_used = 0
+
+    def admit(self, estimate):
+        """
+        Reserve ``estimate`` tokens, returning whether they fit in the quota.
+        """
+        with self.lock:
+            self._roll_over()
+
+            if self.quota > 0 and self.tokens_used + self.reserved + estimate > self.quota:
+                self.rejected += 1
+                return False
+
+            self.reserved += estimate
+            return True
+
+    def release(self, estimate):
+        with self.lock:
+            self.reserved -= estimate
+
+    def record(self, network, channel, user, tokens):
+        with self.lock:
+            self._roll_over()
+
+            key = (network, channel, user)
+            self.usage[key] = self.usage.get(key, 0) + tokens
+            self.tokens_used += tokens
+
+            key = (self.for_date,) + key
+            self.pending[key] = self.pending.get(key, 0) + tokens
+            self.pending_records += 1
+
+            if self.pending_records < self.batch_size:
+                if self.timer is None:
+                    self._schedule_flush(self.flush_interval)
+                return
+
+            # records come in from the event loop, so never write from here
+            if self.timer is not None:
+                self.timer.cancel()
+            self._schedule_flush(0)
+
+    def _schedule_flush(self, delay):
+        self.timer = threading.Timer(delay, self.flush)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def flush(self):
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            pending, self.pending = self.pending, {}
+            self.pending_records = 0
+
+        if not pending:
+            return
+
+        with self.flush_lock, GemmaTokenUsage._meta.database.atomic():
+            for (for_date, network, channel, user), tokens in pending.items():
+                updated = (GemmaTokenUsage
+                    .update(tokens=GemmaTokenUsage.tokens + tokens)
+                    .where(GemmaTokenUsage.for_date == for_date,
+                           GemmaTokenUsage.network == network,
+                           GemmaTokenUsage.channel == channel,
+                           GemmaTokenUsage.user == user)
+                    .execute())
+                if not updated:
+                    GemmaTokenUsage.create(for_date=for_date, network=network, channel=channel,
+                                           user=user, tokens=tokens)
+
+        self.flushes += 1
+
+    def top(self, field, n=3):
+        """
+        Return the ``n`` biggest users of tokens today, grouped by
+        ``field`` (0 for networks, 1 for channels, 2 for users).
+        """
+        with self.lock:
+            totals = {}
+            for key, tokens in self.usage.items():
+                totals[key[field]] = totals.get(key[field], 0) + tokens
+
+        return sorted(totals.items(), key=lambda item: item[1], reverse=True)[:n]
+
+    def __str__(self):
+        return "tokens used on {s.for_date}: {s.tokens_used}{quota}, reserved: {s.reserved}, rejected: {s.rejected}".format(
+            s=self,
+            quota="/{}".format(self.quota) if self.quota > 0 else "",
+        )
+
+
+class PromptStats:
+    def __init__(self):
+        self.prompts = 0
+        self.last_tokens = 0
+        self.total_tokens = 0
+        self.last_build_ms = 0.0
+        self.total_build_ms = 0.0
+
+    def record(self, tokens, build_ms):
+        self.prompts += 1
+        self.last_tokens = tokens
+        self.total_tokens += tokens
+        self.last_build_ms = build_ms
+        self.total_build_ms += build_ms
+
+    def __str__(self):
+        prompts = self.prompts or 1
+        return (
+            "prompts: {s.prompts}, last prompt: ~{s.last_tokens} tokens in {s.last_build_ms:.2f}ms, "
+            "avg prompt: ~{avg_tokens:.0f} tokens in {avg_build_ms:.2f}ms".format(
+                s=self,
+                avg_tokens=self.total_tokens / prompts,
+                avg_build_ms=self.total_build_ms / prompts,
+            )
+        )
+
+
+class ResponseCache:
+    """
+    LRU of model responses, bounded by total size in bytes.
+
+    Entries expire ``ttl`` seconds after they were added. Every hit counts
+    the tokens the original response cost as saved.
+    """
+
+    def __init__(self, max_bytes, ttl):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+
+        self.entries = OrderedDict()
+        self.size = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.tokens_saved = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+
+        if entry is not None and entry[0] < time.monotonic():
+            self._remove(key)
+            entry = None
+
+        if entry is None:
+            self.misses += 1
+            return None
+
+        _, text, tokens = entry
+        self.entries.move_to_end(key)
+        self.hits += 1
+        self.tokens_saved += tokens
+        return text, tokens
+
+    def put(self, key, text, tokens):
+        size = len(text.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+
+        if key in self.entries:
+            self._remove(key)
+
+        self.entries[key] = (time.monotonic() + self.ttl, text, tokens)
+        self.size += size
+
+        while self.size > self.max_bytes:
+            self._remove(next(iter(self.entries)))
+
+    def _remove(self, key):
+        _, text, _ = self.entries.pop(key)
+        self.size -= len(text.encode("utf-8"))
+
+    def __str__(self):
+        return "cache: {entries} responses, {s.size}/{s.max_bytes} bytes, hits: {s.hits}, misses: {s.misses}, tokens saved: {s.tokens_saved}".format(
+            s=self,
+            entries=len(self.entries),
+        )
+
+
+class QueueFull(Exception):
+    pass
+
+
+class RequestScheduler:
+    """
+    Runs model requests with a global and a per-channel concurrency limit.
+
+    Requests past the limits wait their turn, up to ``max_queued`` of them;
+    after that new requests are turned away. A request with the same key as
+    one already in flight waits for that one's result instead of being sent
+    again.
+    """
+
+    def __init__(self, max_running, max_running_per_channel, max_queued):
+        self.max_running_per_channel = max_running_per_channel
+        self.max_queued = max_queued
+
+        self.running = asyncio.Semaphore(max_running)
+        self.channels = {}
+        self.in_flight = {}
+        self.queued = 0
+
+        self.requests = 0
+        self.coalesced = 0
+        self.rejected = 0
+        self.last_wait_ms = 0.0
+        self.total_wait_ms = 0.0
+        self.last_latency_ms = 0.0
+        self.total_latency_ms = 0.0
+        self.streams = 0
+        self.last_first_line_ms = 0.0
+        self.total_first_line_ms = 0.0
+
+    async def submit(self, channel, key, request):
+        """
+        Run the coroutine function ``request`` and return its result.
+        """
+        task = self.in_flight.get(key)
+
+        if task is not None:
+            self.coalesced += 1
+        else:
+            if self.queued >= self.max_queued:
+                self.rejected += 1
+                raise QueueFull
+
+            self.queued += 1
+            task = self.in_flight[key] = asyncio.ensure_future(self._run(channel, request))
+            task.add_done_callback(lambda _: self.in_flight.pop(key, None))
+
+        # one caller going away shouldn't cancel the request for the others
+        return await asyncio.shield(task)
+
+    async def _run(self, channel, request):
+        if channel not in self.channels:
+            self.channels[channel] = asyncio.Semaphore(self.max_running_per_channel)
+
+        queued_at = time.monotonic()
+        try:
+            await self.channels[channel].acquire()
+            try:
+                await self.running.acquire()
+            except BaseException:
+                self.channels[channel].release()
+                raise
+        finally:
+            self.queued -= 1
+
+        try:
+            started_at = time.monotonic()
+            self.requests += 1
+            self.last_wait_ms = (started_at - queued_at) * 1000
+            self.total_wait_ms += self.last_wait_ms
+
+            try:
+                return await request()
+            finally:
+                self.last_latency_ms = (time.monotonic() - started_at) * 1000
+                self.total_latency_ms += self.last_latency_ms
+        finally:
+            self.running.release()
+            self.channels[channel].release()
+
+    def record_first_line(self, first_line_ms):
+        self.streams += 1
+        self.last_first_line_ms = first_line_ms
+        self.total_first_line_ms += first_line_ms
+
+    def __str__(self):
+        requests = self.requests or 1
+        streams = self.streams or 1
+        return (
+            "requests: {s.requests}, queued: {s.queued}, coalesced: {s.coalesced}, rejected: {s.rejected}, "
+            "last wait: {s.last_wait_ms:.0f}ms, avg wait: {avg_wait_ms:.0f}ms, "
+            "last latency: {s.last_latency_ms:.0f}ms, avg latency: {avg_latency_ms:.0f}ms, "
+            "last first line: {s.last_first_line_ms:.0f}ms, avg first line: {avg_first_line_ms:.0f}ms".format(
+                s=self,
+                avg_wait_ms=self.total_wait_ms / requests,
+                avg_latency_ms=self.total_latency_ms / requests,
+                avg_first_line_ms=self.total_first_line_ms / streams,
+            )
+        )
+
+
+BIG_DOG_INSTRUCTIONS = textwrap.dedent("""
+    You are an IRC bot user called Big Dog. You are chatting in {target}.
+    A user has mentioned you in a message, asking for a response.
+    Recent messages are provided to you in the format <username> message.
+    Respond to the most recent message, outputting the message only, in no more than 3 lines, preferably 1.
+""")
+
+HARO_INSTRUCTIONS = textwrap.dedent("""
+    You are a helpful IRC bot user called {name}. You are chatting in {target}.
+    A user has mentioned you in a message, asking for a response.
+    Recent messages are provided to you in the format <username> message.
+    Respond to the most recent message, outputting the message only, in no more than 3 lines, preferably 1.
+""")
+
+# the instructions ask for no more than this many lines, but don't count on it
+MAX_RESPONSE_LINES = 3
+
+# rough estimate, good enough for keeping prompts within budget without
+# running a tokenizer
+CHARS_PER_TOKEN = 4
+
+def estimate_tokens(text):
+    return len(text) // CHARS_PER_TOKEN + 1
+
+FRESH_FLAG = " --fresh"
+QUESTION_NORMALIZE_RE = re.compile(r"[^\w]+")
+
+def normalize_question(question):
+    return QUESTION_NORMALIZE_RE.sub(" ", question.lower()).strip()
+
+def cache_key(name, thinking_level, history, context_lines, question):
+    """
+    Key a response on who was asked what, and the last few lines of
+    channel history it was asked after.
+    """
+    context = "\n".join(history.split("\n")[-context_lines:]) if context_lines > 0 else ""
+    return (
+        name,
+        thinking_level,
+        hashlib.sha1(context.encode("utf-8")).hexdigest(),
+        normalize_question(question),
+    )
 
 
 service = Service(__name__, __doc__)
@@ -30,96 +420,211 @@ service = Service(__name__, __doc__)
 class Config(Config):
     api_key = config.Field(doc="Gemini API key.")
     token_quota = config.Field(doc="Allowable token usage per day.", default=-1)
+    backlog_window = config.Field(doc="Maximum number of recent channel messages to send with each prompt.", default=None)
+    history_token_budget = config.Field(doc="Estimated number of tokens of channel history to send with each prompt.", default=2000)
+    max_concurrent_requests = config.Field(doc="Maximum number of Gemini requests in flight at once.", default=4)
+    max_concurrent_requests_per_channel = config.Field(doc="Maximum number of Gemini requests in flight at once for a single channel.", default=1)
+    max_queued_requests = config.Field(doc="Maximum number of Gemini requests waiting to be sent before new ones are turned away.", default=8)
+    quota_batch_size = config.Field(doc="Number of usage records to collect before writing them to the database.", default=20)
+    quota_flush_interval = config.Field(doc="Maximum number of seconds to hold usage records before writing them to the database.", default=30.0)
+    response_cache_size = config.Field(doc="Maximum size of cached responses in bytes, or 0 to disable the cache.", default=64 * 1024)
+    response_cache_ttl = config.Field(doc="Number of seconds to keep a cached response.", default=600)
+    response_cache_context_lines = config.Field(doc="Number of recent channel messages that must match for a cached response to be used.", default=3)
+    stream_responses = config.Field(doc="Send each line of a response as soon as it has been generated.", default=False)
 
 @service.setup
 def initialize_gemini_api(ctx):
-    ctx.storage.gemini = genai.Client(
-        api_key=ctx.config.api_key,
-        http_options=types.HttpOptions(
-            retry_options=types.HttpRetryOptions(
-                attempts=3,
-                http_status_codes=[503],
-            )
-        )
+    ctx.storage.gemini = None
+    GemmaTokenUsage.create_table(True)
+    ctx.storage.quota = QuotaLedger(ctx.config.token_quota, ctx.config.quota_batch_size,
+                                    ctx.config.quota_flush_interval)
+    ctx.storage.quota.load()
+    ctx.storage.transcripts = {}
+    ctx.storage.prompt_stats = PromptStats()
+    ctx.storage.cache = ResponseCache(ctx.config.response_cache_size, ctx.config.response_cache_ttl)
+    ctx.storage.scheduler = RequestScheduler(
+        ctx.config.max_concurrent_requests,
+        ctx.config.max_concurrent_requests_per_channel,
+        ctx.config.max_queued_requests,
     )
-    ctx.storage.quota = QuotaState.zero()
 
+def get_gemini(ctx):
+    if ctx.storage.gemini is None:
+        from google import genai
+        from google.genai import types
 
-def reset_daily_quota(ctx):
-    if ctx.storage.quota.for_date != date.today():
-        ctx.storage.quota = QuotaState.zero()
+        ctx.storage.gemini = genai.Client(
+            api_key=ctx.config.api_key,
+            http_options=types.HttpOptions(
+                retry_options=types.HttpRetryOptions(
+                    attempts=3,
+                    http_status_codes=[503],
+                )
+            )
+        )
+    return ctx.storage.gemini
 
-def record_quota_usage(ctx, tokens):
-    ctx.storage.quota = ctx.storage.quota._replace(tokens_used=ctx.storage.quota.tokens_used + tokens)
+@service.shutdown
+def flush_quota(ctx):
+    ctx.storage.quota.flush()
 
+@lru_cache(maxsize=256)
 def config_with_instructions(system_instruction, thinking_level):
+    from google.genai import types
+
     return types.GenerateContentConfig(
         automatic_function_calling=types.AutomaticFunctionCallingConfig(disable=True),
         thinking_config=types.ThinkingConfig(thinking_level=thinking_level),
         system_instruction=system_instruction,
     )
 
-def respond(ctx, name, text, config, print_tokens=None):
-    reset_daily_quota(ctx)
+async def send_response(ctx, text):
+    # I'm too cheap to spend extra tokens making sure this doesn't happen
+    if text.startswith(ctx.origin):
+        await ctx.message(text)
+    else:
+        await ctx.respond(text)
 
-    if ctx.config.token_quota > 0 and ctx.storage.quota.tokens_used > ctx.config.token_quota:
-        ctx.respond("Daily token quota exceeded, try again tomorrow.")
-        return
+async def respond(ctx, name, text, instructions, thinking_level, print_tokens=None):
+    from google.genai import errors
+
+    fresh = text.endswith(FRESH_FLAG)
+    if fresh:
+        text = text[:-len(FRESH_FLAG)]
 
+    start = time.monotonic()
     contents = f"<{ctx.origin}> {name}: {text}"
-    if len(ctx.client.backlogs.get(ctx.target, [])) > 1:
-        contents = "\n".join(
-            "<{}> {}".format(m[0] if m[0] != ctx.client.nickname else name, m[1])
-            for m in reversed(list(ctx.client.backlogs[ctx.target])[1:])
-        ) + contents
+    transcript = get_transcript(ctx, ctx.storage.transcripts, ctx.config.backlog_window)
+    history = transcript.text(ctx.client.nickname, name,
+                              budget=ctx.config.history_token_budget, cost=estimate_tokens)
+    if history:
+        contents = history + "\n" + contents
+    estimate = estimate_tokens(contents) + estimate_tokens(instructions)
+    ctx.storage.prompt_stats.record(estimate, (time.monotonic() - start) * 1000)
 
-    try:
-        response = ctx.storage.gemini.models.generate_content(
+    cache = ctx.storage.cache
+    key = None
+    if cache.max_bytes > 0:
+        key = cache_key(name, thinking_level, history, ctx.config.response_cache_context_lines, text)
+
+        cached = cache.get(key) if not fresh else None
+        if cached is not None:
+            cached_text, tokens = cached
+            await send_response(ctx, cached_text)
+            if print_tokens:
+                await ctx.message("cached, saved {} tokens".format(tokens))
+            return
+
+    quota = ctx.storage.quota
+    if not quota.admit(estimate):
+        await ctx.respond("Daily token quota exceeded, try again tomorrow.")
+        return
+
+    streamed = False
+
+    async def generate():
+        response = await get_gemini(ctx).aio.models.generate_content(
             model="gemini-3-flash-preview",
-            config=config,
+            config=config_with_instructions(instructions, thinking_level),
             contents=contents,
         )
-        record_quota_usage(ctx, response.usage_metadata.total_token_count)
+        quota.record(ctx.client.name, ctx.target, ctx.origin, response.usage_metadata.total_token_count)
+        return response.text, response.usage_metadata
 
-        # I'm too cheap to spend extra tokens making sure this doesn't happen
-        if response.text.startswith(ctx.origin):
-            ctx.message(response.text)
-        else:
-            ctx.respond(response.text)
+    async def generate_stream():
+        nonlocal streamed
+        streamed = True
+
+        start = time.monotonic()
+        sent = []
+        pending = ""
+        usage = None
+
+        async def send_line(line):
+            if not line.strip() or len(sent) >= MAX_RESPONSE_LINES:
+                return
+
+            if not sent:
+                ctx.storage.scheduler.record_first_line((time.monotonic() - start) * 1000)
+                await send_response(ctx, line)
+            else:
+                await ctx.message(line)
+            sent.append(line)
+
+        async for chunk in await get_gemini(ctx).aio.models.generate_content_stream(
+            model="gemini-3-flash-preview",
+            config=config_with_instructions(instructions, thinking_level),
+            contents=contents,
+        ):
+            if chunk.usage_metadata is not None:
+                usage = chunk.usage_metadata
+            if not chunk.text:
+                continue
+
+            *lines, pending = (pending + chunk.text).split("\n")
+            for line in lines:
+                await send_line(line)
+
+        await send_line(pending)
+
+        quota.record(ctx.client.name, ctx.target, ctx.origin, usage.total_token_count)
+        return "\n".join(sent), usage
+
+    try:
+        channel = (ctx.client.name, ctx.target)
+
+        # the prompt itself changes with every line said in the channel,
+        # including the question being asked again, so don't key on it
+        response_text, usage = await ctx.storage.scheduler.submit(
+            channel,
+            (channel, instructions, thinking_level, normalize_question(text)),
+            generate_stream if ctx.config.stream_responses else generate,
+        )
+
+        if key is not None:
+            cache.put(key, response_text, usage.total_token_count)
+
+        # a streamed response has already been sent, unless this request was
+        # coalesced into someone else's
+        if not streamed:
+            await send_response(ctx, response_text)
 
         if print_tokens:
-            ctx.message(
+            await ctx.message(
                 "prompt: {m.prompt_token_count}, thoughts: {m.thoughts_token_count}, "
-                "total: {m.total_token_count}".format(m=response.usage_metadata)
+                "total: {m.total_token_count}".format(m=usage)
             )
+    except QueueFull:
+        await ctx.respond("Too many questions at once, try again in a bit.")
     except errors.APIError as e:
-        ctx.respond(f"Gemini returned error: {e.code}: {e.message}")
+        await ctx.respond(f"Gemini returned error: {e.code}: {e.message}")
     except Exception as e:
-        ctx.respond(f"Unexpected error: {e}")
+        await ctx.respond(f"Unexpected error: {e}")
+    finally:
+        quota.release(estimate)
 
 @service.command("big(?P<thinking>ger|gest)?(?P<verbose> verbose)? dog(?P<text>.+)")
-def big_dog(ctx, text, thinking=None, verbose=None):
+async def big_dog(ctx, text, thinking=None, verbose=None):
     """
     Big Dog
 
     Big Dog what is the meaning of the universe?
+
+    End with --fresh to skip cached answers.
     """
     thinking_level = {'ger': 'medium', 'gest': 'high'}.get(thinking, 'minimal')
-    instructions = textwrap.dedent(f"""
-        You are an IRC bot user called Big Dog. You are chatting in {ctx.target}.
-        A user has mentioned you in a message, asking for a response.
-        Recent messages are provided to you in the format <username> message.
-        Respond to the most recent message, outputting the message only, in no more than 3 lines, preferably 1.
-    """)
+    instructions = BIG_DOG_INSTRUCTIONS.format(target=ctx.target)
 
-    respond(ctx, 'Big Dog', text, config=config_with_instructions(instructions, thinking_level), print_tokens=verbose)
+    await respond(ctx, 'Big Dog', text, instructions, thinking_level, print_tokens=verbose)
 
 @service.command("haro(?P<chan>-chan)?(?P<kun>-kun)?(?P<verbose>!)? (?P<text>.+)")
-def haro(ctx, text, chan=None, kun=None, verbose=None):
+async def haro(ctx, text, chan=None, kun=None, verbose=None):
     """
     Haro
 
     Haro are Gundams bad?
+
+    End with --fresh to skip cached answers.
     """
     thinking = 0 + (1 if chan else 0) + (1 if kun else 0)
     thinking_level = ['minimal', 'low', 'medium'][thinking]
@@ -127,16 +632,19 @@ def haro(ctx, text, chan=None, kun=None, verbose=None):
     chan = chan or ''
     kun = kun or ''
 
-    instructions = textwrap.dedent(f"""
-        You are a helpful IRC bot user called Haro{chan}{kun}. You are chatting in {ctx.target}.
-        A user has mentioned you in a message, asking for a response.
-        Recent messages are provided to you in the format <username> message.
-        Respond to the most recent message, outputting the message only, in no more than 3 lines, preferably 1.
-    """)
+    instructions = HARO_INSTRUCTIONS.format(name=f"Haro{chan}{kun}", target=ctx.target)
 
-    respond(ctx, f"Haro{chan}{kun}", text, config=config_with_instructions(instructions, thinking_level), print_tokens=verbose)
+    await respond(ctx, f"Haro{chan}{kun}", text, instructions, thinking_level, print_tokens=verbose)
 
 @service.command("!tokenusage")
-def token_usage(ctx):
-    ctx.respond(ctx.storage.quota)
+async def token_usage(ctx):
+    quota = ctx.storage.quota
+    await ctx.respond(quota)
+    await ctx.message("top channels: {channels}; top users: {users}".format(
+        channels=", ".join("{} {}".format(channel, tokens) for channel, tokens in quota.top(1)) or "none",
+        users=", ".join("{} {}".format(user, tokens) for user, tokens in quota.top(2)) or "none",
+    ))
+    await ctx.message(ctx.storage.prompt_stats)
+    await ctx.message(ctx.storage.scheduler)
+    await ctx.message(ctx.storage.cache)
 
@@ -4,21 +4,34 @@ kedo module.
 Allows mortals to learn from the tome of kedo.
 """
 
+import csv
+import json
 import os
 import re
+import time
 
-from collections import defaultdict
-from random import choice, randint, random
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from random import choice, randint
+from urllib.parse import urlencode
 
-from peewee import CharField, fn
-from tornado.web import RequestHandler, Application
+from peewee import CharField
+from tornado.web import HTTPError, RequestHandler, Application
 
+from kochira import config
 from kochira.auth import requires_permission
 from kochira.db import Model
-from kochira.service import Service
+from kochira.service import Service, Config
+
+from . import transforms
+from .backlog import previous_line
 
 service = Service(__name__, __doc__)
 
+@service.config
+class Config(Config):
+    bits_dir = config.Field(doc="Directory that bits are imported from and exported to.", default="kedo")
+
 class KedoBit(Model):
     topic = CharField(255)
     knowledge = CharField(450)
@@ -28,9 +41,210 @@ class KedoBit(Model):
             (("topic",), False),
         )
 
+class KedoTome:
+    """
+    Write-through cache of every topic and its knowledge.
+
+    The whole tome is loaded once, and reads are served from memory. Writes
+    go to the database and then update the cache.
+    """
+
+    def __init__(self):
+        self.topics = {}
+        self.hits = 0
+        self.misses = 0
+        self.version = 0
+        self.epoch = None
+        self.modified = None
+        self.searchable = False
+
+    def bump(self):
+        self.version += 1
+        self.modified = datetime.now(timezone.utc).replace(microsecond=0)
+
+    def load(self):
+        # versions restart from zero on every load, so tell them apart from
+        # the last load's
+        self.epoch = os.urandom(4).hex()
+        self.topics = {}
+        for topic, knowledge in KedoBit.select(KedoBit.topic, KedoBit.knowledge).order_by(KedoBit.id).tuples():
+            self.topics.setdefault(topic, []).append(knowledge)
+        self.bump()
+
+    def get(self, topic):
+        bits = self.topics.get(topic)
+        if bits:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return bits
+
+    def learn(self, topic, knowledge):
+        self.topics.setdefault(topic, []).append(knowledge)
+        self.bump()
+
+    def learn_many(self, bits):
+        for topic, knowledge in bits:
+            self.topics.setdefault(topic, []).append(knowledge)
+        self.bump()
+
+    def forget(self, topic):
+        self.topics.pop(topic, None)
+        self.bump()
+
+tome = KedoTome()
+
+IMPORT_CHUNK_SIZE = 400
+
+SEARCH_RESULTS = 3
+MAX_SEARCH_RESULTS = 100
+
+def search_table():
+    table = getattr(KedoBit._meta, "table_name", None) or KedoBit._meta.db_table
+    return table, table + "_fts"
+
+def create_search_index():
+    """
+    Create the FTS5 index over the tome, kept in sync with triggers.
+
+    Returns whether full-text search is available.
+    """
+    database = KedoBit._meta.database
+    table, fts = search_table()
+
+    if database.execute_sql("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+                            (fts,)).fetchone():
+        return True
+
+    try:
+        with database.atomic():
+            database.execute_sql(
+                "CREATE VIRTUAL TABLE {fts} USING fts5(topic, knowledge, "
+                "content='{table}', content_rowid='id')".format(fts=fts, table=table))
+            database.execute_sql(
+                "CREATE TRIGGER {fts}_ai AFTER INSERT ON {table} BEGIN "
+                "INSERT INTO {fts}(rowid, topic, knowledge) VALUES (new.id, new.topic, new.knowledge); "
+                "END".format(fts=fts, table=table))
+            database.execute_sql(
+                "CREATE TRIGGER {fts}_ad AFTER DELETE ON {table} BEGIN "
+                "INSERT INTO {fts}({fts}, rowid, topic, knowledge) VALUES ('delete', old.id, old.topic, old.knowledge); "
+                "END".format(fts=fts, table=table))
+            database.execute_sql(
+                "CREATE TRIGGER {fts}_au AFTER UPDATE ON {table} BEGIN "
+                "INSERT INTO {fts}({fts}, rowid, topic, knowledge) VALUES ('delete', old.id, old.topic, old.knowledge); "
+                "INSERT INTO {fts}(rowid, topic, knowledge) VALUES (new.id, new.topic, new.knowledge); "
+                "END".format(fts=fts, table=table))
+            database.execute_sql("INSERT INTO {fts}({fts}) VALUES ('rebuild')".format(fts=fts))
+    except Exception:
+        # the database isn't SQLite, or SQLite was built without FTS5
+        return False
+
+    return True
+
+def search(terms, limit):
+    """
+    Search the tome, returning (topic, knowledge) pairs ranked by relevance.
+    Matches in the topic count double.
+    """
+    _, fts = search_table()
+    query = " ".join('"{}"'.format(term.replace('"', '""')) for term in terms.split())
+    if not query:
+        return []
+
+    return KedoBit._meta.database.execute_sql(
+        "SELECT topic, knowledge FROM {fts} WHERE {fts} MATCH ? "
+        "ORDER BY bm25({fts}, 2.0, 1.0) LIMIT ?".format(fts=fts),
+        (query, limit)).fetchall()
+
+def bit_format(path):
+    _, ext = os.path.splitext(path)
+    if ext not in (".jsonl", ".csv"):
+        raise ValueError("don't know how to read or write {} files".format(ext or "extensionless"))
+    return ext[1:]
+
+def bits_path(bits_dir, name):
+    """
+    Resolve a file name inside the bits directory, refusing any that would
+    end up outside of it.
+    """
+    root = os.path.realpath(bits_dir)
+    path = os.path.realpath(os.path.join(root, name))
+    if os.path.commonpath([root, path]) != root:
+        raise ValueError("{} isn't in the bits directory".format(name))
+    return path
+
+def read_bits(f, fmt):
+    if fmt == "jsonl":
+        for n, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+
+            try:
+                bit = json.loads(line)
+                yield bit["topic"], bit["knowledge"]
+            except (ValueError, KeyError, TypeError) as e:
+                raise ValueError("line {}: not a bit ({!r})".format(n, e))
+    else:
+        reader = csv.reader(f)
+        for row in reader:
+            if not row or row == ["topic", "knowledge"]:
+                continue
+
+            if len(row) != 2:
+                raise ValueError("line {}: expected a topic and knowledge, got {} fields".format(
+                    reader.line_num, len(row)))
+            topic, knowledge = row
+            yield topic, knowledge
+
+def write_bits(f, fmt, bits):
+    if fmt == "jsonl":
+        for topic, knowledge in bits:
+            f.write(json.dumps({"topic": topic, "knowledge": knowledge}) + "\n")
+    else:
+        writer = csv.writer(f)
+        writer.writerow(["topic", "knowledge"])
+        writer.writerows(bits)
+
+def import_bits(bits):
+    """
+    Insert (topic, knowledge) pairs in chunked transactions, skipping any
+    already in the tome or repeated in the input.
+
+    Returns the number of bits imported and skipped.
+    """
+    seen = {(topic, knowledge) for topic, knowledges in tome.topics.items() for knowledge in knowledges}
+    imported = 0
+    skipped = 0
+    chunk = []
+
+    def flush():
+        with KedoBit._meta.database.atomic():
+            KedoBit.insert_many([{"topic": topic, "knowledge": knowledge} for topic, knowledge in chunk]).execute()
+        tome.learn_many(chunk)
+
+    for bit in bits:
+        if bit in seen:
+            skipped += 1
+            continue
+
+        seen.add(bit)
+        chunk.append(bit)
+        imported += 1
+
+        if len(chunk) >= IMPORT_CHUNK_SIZE:
+            flush()
+            chunk = []
+
+    if chunk:
+        flush()
+
+    return imported, skipped
+
 @service.setup
-def initialize_model(bot):
+def initialize_model(ctx):
     KedoBit.create_table(True)
+    tome.load()
+    tome.searchable = create_search_index()
 
 @service.command(r"kedo on (?P<topic>[^:]+)$", mention=True)
 @service.command(r"!kedo (?P<topic>.+)$")
@@ -40,15 +254,16 @@ def kedo(ctx, topic):
 
     Query the tome of kedo and return the results.
     """
-    if not KedoBit.select().where(KedoBit.topic == topic).exists():
+    bits = tome.get(topic)
+    if not bits:
         ctx.respond("kedo hasn't said anything about {topic} yet. poop.".format(
             topic=topic
         ))
         return
 
-    ctx.message("\x02kedo on {topic}:\x02 {bit.knowledge}".format(
+    ctx.message("\x02kedo on {topic}:\x02 {knowledge}".format(
         topic=topic,
-        bit=KedoBit.select().where(KedoBit.topic == topic).order_by(fn.Random()).limit(1)[0]))
+        knowledge=choice(bits)))
 
 @service.command(r"kedo on (?P<topic>.*\w)\s*: (?P<knowledge>.+)$", mention=True)
 @service.command(r"!kedolearn (?P<topic>.+) : (?P<knowledge>.+)$")
@@ -60,7 +275,8 @@ def kedo_learn(ctx, topic, knowledge):
     Instill new knowledge into the tome of kedo. Multiple entries on the
     same topic are allowed.
     """
-    KedoBit.create(topic=topic, knowledge=knowledge).save()
+    KedoBit.create(topic=topic, knowledge=knowledge)
+    tome.learn(topic, knowledge)
 
     ctx.respond("kedo now knows about \x02{topic}\x02!".format(topic=topic))
 
@@ -75,9 +291,65 @@ def kedo_forget(ctx, topic):
     the same topic, they are all removed.
     """
     KedoBit.delete().where(KedoBit.topic == topic).execute()
+    tome.forget(topic)
 
     ctx.respond("kedo no longer knows about \x02{topic}\x02.".format(topic=topic))
 
+@service.command(r"!kedoimport (?P<path>\S+)$")
+@requires_permission("admin")
+def kedo_import(ctx, path):
+    """
+    kedoimport
+
+    Import bits from a .jsonl or .csv file in the bits directory into the
+    tome of kedo. Bits kedo already knows are skipped.
+    """
+    try:
+        fmt = bit_format(path)
+        start = time.monotonic()
+        with open(bits_path(ctx.config.bits_dir, path), "r", newline="") as f:
+            # read the whole file first, so a bad line doesn't leave it half
+            # imported
+            bits = list(read_bits(f, fmt))
+        imported, skipped = import_bits(bits)
+        elapsed = time.monotonic() - start
+    except (OSError, ValueError) as e:
+        ctx.respond("couldn't import {path}: {e}".format(path=path, e=e))
+        return
+
+    ctx.respond("kedo learned \x02{imported}\x02 bits ({skipped} already known) in {elapsed:.2f}s, {rate:.0f} bits/s.".format(
+        imported=imported,
+        skipped=skipped,
+        elapsed=elapsed,
+        rate=(imported + skipped) / elapsed if elapsed else 0.0))
+
+@service.command(r"!kedoexport (?P<path>\S+)$")
+@requires_permission("admin")
+def kedo_export(ctx, path):
+    """
+    kedoexport
+
+    Export the tome of kedo to a .jsonl or .csv file in the bits directory.
+    """
+    bits = [(topic, knowledge) for topic, knowledges in tome.topics.items() for knowledge in knowledges]
+
+    try:
+        fmt = bit_format(path)
+        start = time.monotonic()
+        filename = bits_path(ctx.config.bits_dir, path)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(filename, "w", newline="") as f:
+            write_bits(f, fmt, bits)
+        elapsed = time.monotonic() - start
+    except (OSError, ValueError) as e:
+        ctx.respond("couldn't export to {path}: {e}".format(path=path, e=e))
+        return
+
+    ctx.respond("kedo wrote \x02{count}\x02 bits in {elapsed:.2f}s, {rate:.0f} bits/s.".format(
+        count=len(bits),
+        elapsed=elapsed,
+        rate=len(bits) / elapsed if elapsed else 0.0))
+
 @service.command(r"what does kedo know about\??$", mention=True)
 @service.command(r"!kedo$")
 def kedolist(ctx):
@@ -87,23 +359,183 @@ def kedolist(ctx):
     List all scripture in the book of kedo.
     """
     ctx.message("\x02kedo knows about:\x02 {things}".format(
-        things=", ".join([x.topic for x in KedoBit.select().group_by(KedoBit.topic)])
+        things=", ".join(sorted(tome.topics))
     ))
 
+@service.command(r"!kedosearch (?P<terms>.+)$")
+def kedosearch(ctx, terms):
+    """
+    kedosearch
 
-class IndexHandler(RequestHandler):
-    def get(self):
-        kedos = defaultdict(list)
-        for bit in KedoBit.select():
-            kedos[bit.topic].append(bit.knowledge)
+    Search all scripture in the book of kedo.
+    """
+    if not tome.searchable:
+        ctx.respond("the tome of kedo can't be searched here.")
+        return
+
+    results = search(terms, SEARCH_RESULTS)
+    if not results:
+        ctx.respond("kedo hasn't said anything about {terms} yet. poop.".format(terms=terms))
+        return
+
+    for topic, knowledge in results:
+        ctx.message("\x02kedo on {topic}:\x02 {knowledge}".format(
+            topic=topic,
+            knowledge=knowledge))
+
+@service.command(r"!kedostats$")
+def kedostats(ctx):
+    """
+    kedostats
+
+    Show how the tome of kedo is being consulted.
+    """
+    ctx.message("\x02kedo tome:\x02 {topics} topics, {bits} bits, hits: {t.hits}, misses: {t.misses}".format(
+        topics=len(tome.topics),
+        bits=sum(len(bits) for bits in tome.topics.values()),
+        t=tome,
+    ))
+
+
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+FLUSH_EVERY = 50
+
+
+class TomeHandler(RequestHandler):
+    """
+    Base handler for views of the tome.
 
+    Responses are validated against the tome's version, and can be narrowed
+    down with the ``topic``, ``page`` and ``per_page`` arguments.
+    """
+
+    default_page_size = None
+
+    def compute_etag(self):
+        return '"{}-{}-{}"'.format(tome.epoch, tome.version, self.request.query)
+
+    def not_modified_since(self):
+        since = self.request.headers.get("If-Modified-Since")
+        if since is None or "If-None-Match" in self.request.headers:
+            return False
+
+        try:
+            return parsedate_to_datetime(since) >= tome.modified
+        except (TypeError, ValueError):
+            return False
+
+    def prepare(self):
+        self.set_header("Last-Modified", tome.modified)
+        self.set_etag_header()
+
+        if self.check_etag_header() or self.not_modified_since():
+            self.set_status(304)
+            self.finish()
+
+    def int_argument(self, name, default):
+        value = self.get_argument(name, None)
+        if value is None:
+            return default
+
+        try:
+            value = int(value)
+        except ValueError:
+            raise HTTPError(400, "{} must be a number".format(name))
+
+        if value < 1:
+            raise HTTPError(400, "{} must be positive".format(name))
+        return value
+
+    def selected_topics(self):
+        """
+        Return the selected page of (topic, knowledge) pairs, the page number
+        and the number of pages.
+        """
+        topic = self.get_argument("topic", None)
+        if topic is not None:
+            topics = [topic] if topic in tome.topics else []
+        else:
+            topics = list(tome.topics)
+
+        per_page = self.int_argument("per_page", self.default_page_size)
+        if per_page is None and "page" not in self.request.arguments:
+            # unpaged exports get the whole tome, they're streamed anyway
+            per_page = len(topics) or 1
+        else:
+            per_page = min(per_page or PAGE_SIZE, MAX_PAGE_SIZE)
+
+        page = self.int_argument("page", 1)
+        pages = max(1, (len(topics) + per_page - 1) // per_page)
+
+        topics = topics[(page - 1) * per_page:page * per_page]
+        return [(topic, list(tome.topics[topic])) for topic in topics], page, pages
+
+    def page_url(self, page):
+        """
+        Return the query string for another page of the same selection.
+        """
+        args = {name: self.get_argument(name) for name in ("topic", "per_page")
+                if self.get_argument(name, None) is not None}
+        args["page"] = page
+        return "?" + urlencode(args)
+
+
+class IndexHandler(TomeHandler):
+    default_page_size = PAGE_SIZE
+
+    def get(self):
+        kedos, page, pages = self.selected_topics()
         self.render("../../../../../../kochira_caa/kochira_caa/templates/kedo.html",
-                    kedos=kedos)
+                    kedos=kedos, page=page, pages=pages, page_url=self.page_url,
+                    topic=self.get_argument("topic", None))
+
+
+class TextHandler(TomeHandler):
+    async def get(self):
+        kedos, _, _ = self.selected_topics()
+        self.set_header("Content-Type", "text/plain; charset=UTF-8")
+
+        for i, (topic, bits) in enumerate(kedos, 1):
+            self.write("{}\n{}\n\n".format(topic.title(), "\n".join(bits)))
+            if i % FLUSH_EVERY == 0:
+                await self.flush()
+
+
+class JSONHandler(TomeHandler):
+    async def get(self):
+        kedos, _, _ = self.selected_topics()
+        self.set_header("Content-Type", "application/json; charset=UTF-8")
+
+        self.write("{")
+        for i, (topic, bits) in enumerate(kedos, 1):
+            self.write("{}{}: {}".format(", " if i > 1 else "", json.dumps(topic), json.dumps(bits)))
+            if i % FLUSH_EVERY == 0:
+                await self.flush()
+        self.write("}")
+
+
+class SearchHandler(TomeHandler):
+    def get(self):
+        if not tome.searchable:
+            raise HTTPError(501, "full-text search is unavailable")
+
+        terms = self.get_argument("q")
+        limit = min(self.int_argument("limit", 20), MAX_SEARCH_RESULTS)
+
+        self.set_header("Content-Type", "application/json; charset=UTF-8")
+        self.write(json.dumps([
+            {"topic": topic, "knowledge": knowledge}
+            for topic, knowledge in search(terms, limit)
+        ]))
 
 
 def make_application(settings):
     return Application([
-        (r"/", IndexHandler)
+        (r"/", IndexHandler),
+        (r"/kedo.txt", TextHandler),
+        (r"/kedo.json", JSONHandler),
+        (r"/search", SearchHandler),
     ], **settings)
 
 
@@ -133,20 +565,13 @@ def nichi(ctx, text=None):
     ,,,n,ic,,,hi
     """
     if text is None:
-        if len(ctx.client.backlogs[ctx.target]) == 1:
+        line = previous_line(ctx)
+        if line is None:
             return
 
-        _, text = ctx.client.backlogs[ctx.target][1]
+        _, text = line
 
-    new_text = ''
-    for c in text:
-        if random() < 0.4:
-            if random() < 0.3:
-                new_text += ',' * randint(3,6)
-            else:
-                new_text += ',' * randint(1,2)
-        new_text += c
-    ctx.message(new_text)
+    ctx.message(transforms.nichi(text))
 
 @service.command(r"!spongebob(?: (?P<text>.+))?")
 def spongebob(ctx, text=None):
@@ -154,22 +579,11 @@ def spongebob(ctx, text=None):
     ReCrEatIonaL dRugS And heAVY aLcoHOl CONsUMpTIoN HAVe bEEn nORmal aMOng YOUNg pEOPle THE laST haLf cenTUry
     """
     if text is None:
-        if len(ctx.client.backlogs[ctx.target]) == 1:
+        line = previous_line(ctx)
+        if line is None:
             return
 
-        _, text = ctx.client.backlogs[ctx.target][1]
-
-    new_text = ''
-    run_length = 1
-    current_transform = str.upper if random() < 0.5 else str.lower
-    for c in text:
-        new_text += current_transform(c)
-
-        if random() > 0.75 ** (run_length * 1.5):
-            current_transform = str.upper if current_transform is str.lower else str.lower
-            run_length = 1
-        else:
-            run_length += 1
+        _, text = line
 
-    ctx.message(new_text)
+    ctx.message(transforms.spongebob(text))
 
@@ -9,15 +9,18 @@ N
 
 from kochira.service import Service
 
+from .backlog import previous_line
+
 service = Service(__name__, __doc__)
 
 @service.command(r"!london(?: (?P<what>.{1,10}))?$")
 def london(ctx, what=None):
     if what is None:
-        if len(ctx.client.backlogs[ctx.target]) == 1 or len(ctx.client.backlogs[ctx.target][1][1]) > 10:
+        line = previous_line(ctx)
+        if line is None or len(line[1]) > 10:
             return
 
-        _, what = ctx.client.backlogs[ctx.target][1]
+        _, what = line
     ctx.message(what.upper())
     for x in what.upper()[1:]:
         ctx.message(
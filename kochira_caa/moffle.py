@@ -3,8 +3,11 @@ Moffle search.
 
 For when you really want context.
 """
+import asyncio
 import hmac
+import time
 from base64 import urlsafe_b64encode
+from collections import OrderedDict
 from hashlib import sha256
 from itertools import count, compress
 from urllib.parse import quote_plus, unquote_plus
@@ -14,6 +17,8 @@ from kochira.service import Service, Config
 
 service = Service(__name__, __doc__)
 
+MAX_CACHED_SEARCHES = 128
+
 @service.config
 class MoffleConfig(Config):
     class Instance(Config):
@@ -21,51 +26,72 @@ class MoffleConfig(Config):
         api_uid = config.Field(doc="UID for API authentication.")
         api_key = config.Field(doc="Key for API authentication.")
     instances = config.Field(doc="Moffle instances keyed by name.", type=config.Mapping(Instance))
+    timeout = config.Field(doc="Seconds to wait for an instance when searching all of them.", default=5.0)
+    cache_ttl = config.Field(doc="Seconds to remember search results for.", default=60)
+
+@service.setup
+def initialize_cache(ctx):
+    ctx.storage.searches = OrderedDict()
+    ctx.storage.signers = {}
 
-def sign_request(key, path, args):
+def sign_request(signer, path, args):
     path = unquote_plus(path).encode('utf_8') + b'?'
     args = '&'.join(sorted(["{}={}".format(k, v) for k, v in args.items()])).encode('utf_8')
 
-    m = hmac.new(key.encode('utf_8'), digestmod=sha256)
+    m = signer.copy()
     m.update(path)
     m.update(args)
-    return urlsafe_b64encode(m.digest())
+    return urlsafe_b64encode(m.digest()).decode('ascii')
+
+def get_signer(ctx, key):
+    """
+    Return an HMAC keyed with ``key`` to copy for each request, so the key
+    is only set up once.
+    """
+    if key not in ctx.storage.signers:
+        ctx.storage.signers[key] = hmac.new(key.encode('utf_8'), digestmod=sha256)
+    return ctx.storage.signers[key]
 
-async def _search(http, instance, network, channel, text):
+async def _search(http, signer, instance, network, channel, text):
     path = '/api/search/{network}/{channel}'.format(
         network=quote_plus(network),
         channel=quote_plus(channel)
     )
     args = {'q': text, 'uid': instance.api_uid}
-    args.update({'sig': sign_request(instance.api_key, path, args)})
+    args.update({'sig': sign_request(signer, path, args)})
     result = await http.get(instance.base_url.rstrip('/') + path, params=args)
     result.raise_for_status()
     return result.json()
 
-@service.command(r"search (?P<instance>\w+) for (?P<text>.+)$", mention=True)
-async def search(ctx, instance, text):
+async def cached_search(ctx, name, text):
     """
-    Search
-
-    Searches a Moffle instance for things.
+    Search the named instance for the current channel, reusing results from
+    the last ``cache_ttl`` seconds.
     """
-    instance = instance.lower()
-    if not instance in ctx.config.instances:
-        await ctx.respond("I don't know what \"{instance}\" is!".format(instance=instance))
-        return
-    instance = ctx.config.instances[instance]
+    instance = ctx.config.instances[name]
+    key = (name, ctx.client.name.lower(), ctx.target.lower(), text)
+    searches = ctx.storage.searches
 
-    r = await _search(ctx.bot.http, instance, ctx.client.name.lower(), ctx.target.lower(), text)
-    if r is None or r['total_results'] < 2:
-        await ctx.respond("No results found for \"{text}\"!".format(text=text))
-        return
+    cached = searches.get(key)
+    if cached is not None and cached[0] > time.monotonic():
+        return cached[1]
+
+    r = await _search(ctx.bot.http, get_signer(ctx, instance.api_key), instance,
+                      ctx.client.name.lower(), ctx.target.lower(), text)
+
+    searches.pop(key, None)
+    searches[key] = (time.monotonic() + ctx.config.cache_ttl, r)
+    while len(searches) > MAX_CACHED_SEARCHES:
+        searches.popitem(last=False)
 
+    return r
+
+async def show_result(ctx, instance, r):
     result = r['results'][1]
     match_idx = list(compress(count(), [1 if line['line_marker'] == ':' else 0 for line in result['lines']]))[0]
     lines = result['lines'][max(0, match_idx-2):min(match_idx+3, len(result['lines']))]
 
-    for line in lines:
-        await ctx.message(line['line'])
+    await ctx.message("\n".join(line['line'] for line in lines))
 
     await ctx.message("\x02Log from:\x02 {date}. \x02Total results:\x02 {total}. {base}{path}".format(
         date=result['date'],
@@ -73,3 +99,53 @@ async def search(ctx, instance, text):
         base=instance.base_url.rstrip('/'),
         path=r['canonical_url']
     ))
+
+async def search_all(ctx, text):
+    names = list(ctx.config.instances)
+
+    async def search_one(name):
+        return await asyncio.wait_for(cached_search(ctx, name, text), ctx.config.timeout)
+
+    responses = await asyncio.gather(*[search_one(name) for name in names], return_exceptions=True)
+
+    found = sorted(
+        ((r['results'][1]['date'], name, r) for name, r in zip(names, responses)
+         if not isinstance(r, BaseException) and r is not None and r['total_results'] >= 2),
+        key=lambda hit: hit[0], reverse=True)
+
+    if not found:
+        await ctx.respond("No results found for \"{text}\" anywhere!".format(text=text))
+        return
+
+    _, name, r = found[0]
+    await show_result(ctx, ctx.config.instances[name], r)
+
+    if len(found) > 1:
+        await ctx.message("\x02Also in:\x02 {others}".format(others=", ".join(
+            "{name} ({date}, {total} results)".format(name=name, date=date, total=r['total_results'])
+            for date, name, r in found[1:]
+        )))
+
+@service.command(r"search (?P<instance>\w+) for (?P<text>.+)$", mention=True)
+async def search(ctx, instance, text):
+    """
+    Search
+
+    Searches a Moffle instance for things. Search "all" to search every
+    instance at once.
+    """
+    instance = instance.lower()
+    if instance == "all" and instance not in ctx.config.instances:
+        await search_all(ctx, text)
+        return
+
+    if not instance in ctx.config.instances:
+        await ctx.respond("I don't know what \"{instance}\" is!".format(instance=instance))
+        return
+
+    r = await cached_search(ctx, instance, text)
+    if r is None or r['total_results'] < 2:
+        await ctx.respond("No results found for \"{text}\"!".format(text=text))
+        return
+
+    await show_result(ctx, ctx.config.instances[instance], r)
@@ -5,24 +5,24 @@ nattobrain pkls go
 from random import random
 
 from kochira.service import Service, background
-from cobe.brain import Brain
 
-service = Service(__name__, __doc__)
+from .brainpool import pool
+
+NATTO_BRAIN = "natto.db"
+ADREI_BRAIN = "a-drei.db"
 
-@service.setup
-def load_brain(ctx):
-    ctx.storage.brain = Brain("natto.db", check_same_thread=False)
-    ctx.storage.adrei = Brain("a-drei.db", check_same_thread=False)
+service = Service(__name__, __doc__)
 
 @service.shutdown
 def unload_brain(ctx):
-    ctx.storage.brain.graph.close()
-    ctx.storage.adrei.graph.close()
+    pool.close(NATTO_BRAIN)
+    pool.close(ADREI_BRAIN)
 
 @service.command(r":natto:", mention=False)
 @background
 def generate_natto(ctx):
-    msg = ctx.storage.brain.reply('')
+    with pool.checkout(NATTO_BRAIN) as brain:
+        msg = brain.reply('')
     if random() < 0.2:
         ctx.message('<nattofriends> ' + msg[:-1])
         ctx.message('<nattofriends> ' + msg[-1])
@@ -32,4 +32,6 @@ def generate_natto(ctx):
 @service.command(r":a-drei:", mention=False)
 @background
 def generate_adrei(ctx):
-    ctx.message('\x02[@cute_hospital]\x02 ' + ctx.storage.adrei.reply(''))
+    with pool.checkout(ADREI_BRAIN) as brain:
+        msg = brain.reply('')
+    ctx.message('\x02[@cute_hospital]\x02 ' + msg)
@@ -1,22 +1,41 @@
-import nltk
+"""
+Pasta generator.
+
+Good memes from a markov chain trained on copypasta. Train a model with:
+
+    python -m kochira_caa.pasta corpus.txt pasta_model.json
+"""
+
+import os
 import re
+import threading
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from itertools import islice
 from kochira import config
 from kochira.service import Service, Config
+from markovify import Chain
 from markovify.text import NewlineText
 
+from .pasta_chain import CompiledChain, is_compiled, write_compiled
+
 service = Service(__name__, __doc__)
 
 
 @service.config
 class Config(Config):
-    model_file = config.Field(doc="Location where the model file is stored", default="pasta_model.json")
+    model_file = config.Field(doc="Location where the model file is stored, either as JSON or as a compiled chain", default="pasta_model.json")
+    pool_size = config.Field(doc="Number of sentences to keep generated ahead of time.", default=50)
+    pool_low_watermark = config.Field(doc="Refill the sentence pool once it has this many sentences left.", default=10)
 
 
 class POSifiedText(NewlineText):
     def word_split(self, sentence):
+        from nltk import pos_tag
+
         words = re.split(self.word_split_pattern, sentence)
         words = filter(lambda x: bool(x), words)
-        words = ["::".join(tag) for tag in nltk.pos_tag(words)]
+        words = ["::".join(tag) for tag in pos_tag(words)]
         return words
 
     def word_join(self, words):
@@ -24,28 +43,216 @@ class POSifiedText(NewlineText):
         return sentence
 
 
+class PastaText(POSifiedText):
+    """
+    POSifiedText that only generates sentences from a trained chain.
+
+    The untagged form of every token is worked out once when the model is
+    loaded, and the tagger is never loaded or run.
+    """
+
+    def __init__(self, chain):
+        super().__init__(None, state_size=chain.state_size, chain=chain, retain_original=False)
+
+        if isinstance(chain, CompiledChain):
+            tokens = (chain.token(i) for i in range(chain.token_count))
+        else:
+            tokens = {word for state, nexts in chain.model.items() for word in (*state, *nexts)}
+
+        self.surfaces = {token: token.split("::")[0] for token in tokens}
+
+    def word_split(self, sentence):
+        raise RuntimeError("PastaText can't tag text, train with POSifiedText instead")
+
+    def word_join(self, words):
+        return " ".join([self.surfaces[word] for word in words])
+
+
+class SentencePool:
+    """
+    Sentences generated ahead of time by a background thread.
+
+    The pool is topped back up to ``size`` sentences whenever it drops to
+    ``low_watermark``. If it runs dry, a sentence is generated on the spot
+    and counted as a stall.
+    """
+
+    def __init__(self, model, size, low_watermark):
+        self.model = model
+        self.size = size
+        self.low_watermark = low_watermark
+
+        self.sentences = deque()
+        self.cond = threading.Condition()
+        self.stopped = False
+
+        self.hits = 0
+        self.stalls = 0
+
+        self.thread = threading.Thread(target=self._refill, name="pasta-pool", daemon=True)
+        self.thread.start()
+
+    def _refill(self):
+        while True:
+            with self.cond:
+                while not self.stopped and len(self.sentences) > self.low_watermark:
+                    self.cond.wait()
+
+                if self.stopped:
+                    return
+
+            while not self.stopped and len(self.sentences) < self.size:
+                sentence = self.model.make_sentence()
+                if sentence is not None:
+                    self.sentences.append(sentence)
+
+    def get(self):
+        try:
+            sentence = self.sentences.popleft()
+            self.hits += 1
+        except IndexError:
+            sentence = self.model.make_sentence()
+            self.stalls += 1
+
+        if len(self.sentences) <= self.low_watermark:
+            with self.cond:
+                self.cond.notify()
+
+        return sentence
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify()
+        self.thread.join()
+
+
 @service.setup
 def load_model(ctx):
-    with open(ctx.config.model_file, 'r') as f:
-        ctx.storage.model = POSifiedText.from_chain(f.read())
+    if is_compiled(ctx.config.model_file):
+        chain = CompiledChain(ctx.config.model_file)
+    else:
+        with open(ctx.config.model_file, 'r') as f:
+            chain = Chain.from_json(f.read())
+
+    ctx.storage.model = PastaText(chain)
+
+    ctx.storage.pool = SentencePool(ctx.storage.model, ctx.config.pool_size, ctx.config.pool_low_watermark)
 
 
-@service.command('!pasta')
+@service.shutdown
+def unload_model(ctx):
+    ctx.storage.pool.stop()
+
+    if isinstance(ctx.storage.model.chain, CompiledChain):
+        ctx.storage.model.chain.close()
+
+
+@service.command(r"!pasta$")
 def generate_pasta(ctx):
     """
     🐸♊️🐸♊️🐸♊️🐸♊️🐸♊️ good memes go౦ԁ mEmes
     """
-    ctx.message(ctx.storage.model.make_sentence())
+    ctx.message(ctx.storage.pool.get())
+
+
+@service.command(r"!pastastats$")
+def pasta_stats(ctx):
+    """
+    Pasta stats.
+
+    Show how well the sentence pool is keeping up.
+    """
+    pool = ctx.storage.pool
+    ctx.message("\x02pasta pool:\x02 {size}/{p.size} ready, hits: {p.hits}, stalls: {p.stalls}".format(
+        size=len(pool.sentences),
+        p=pool,
+    ))
+
+
+def train_chunk(lines, state_size):
+    """
+    Tag a chunk of corpus lines and return its chain model.
+    """
+    try:
+        return POSifiedText("\n".join(lines), state_size=state_size, retain_original=False).chain.model
+    except KeyError:
+        # markovify can't build a chain without any usable sentences
+        return {}
+
+
+def merge_models(model, other):
+    """
+    Merge the chain model ``other`` into ``model`` by summing weights.
+    """
+    for state, nexts in other.items():
+        merged = model.setdefault(state, {})
+        for word, weight in nexts.items():
+            merged[word] = merged.get(word, 0) + weight
+    return model
+
+
+def train(f, state_size=2, workers=None, chunk_size=1000, model=None):
+    """
+    Train a chain model from the corpus file ``f``, streaming it in chunks of
+    ``chunk_size`` lines to a pool of ``workers`` processes. If ``model`` is
+    given, the new text is merged into it.
+    """
+    if model is None:
+        model = {}
+
+    workers = workers or os.cpu_count() or 1
+    max_pending = workers * 2
+    pending = set()
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+
+        while True:
+            lines = list(islice(f, chunk_size))
+            if lines:
+                pending.add(executor.submit(train_chunk, lines, state_size))
+
+            if pending and (len(pending) >= max_pending or not lines):
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    merge_models(model, future.result())
+
+            if not lines and not pending:
+                return model
 
 
 if __name__ == '__main__':
-    import sys
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser(prog="python -m kochira_caa.pasta", description="Train a pasta model.")
+    parser.add_argument("corpus", help="newline-separated corpus to train on")
+    parser.add_argument("model", help="where to write the JSON model")
+    parser.add_argument("--compiled", metavar="PATH", help="also write a compiled chain to PATH")
+    parser.add_argument("--update", action="store_true", help="merge the corpus into the existing model instead of replacing it")
+    parser.add_argument("--workers", type=int, default=None, help="number of tagging processes (default: one per CPU)")
+    parser.add_argument("--chunk-size", type=int, default=1000, help="number of corpus lines per tagging job")
+    parser.add_argument("--state-size", type=int, default=2, help="state size of a new model")
+    args = parser.parse_args()
+
+    model = None
+    state_size = args.state_size
+
+    if args.update and os.path.exists(args.model):
+        with open(args.model, 'r') as f:
+            chain = Chain.from_json(f.read())
+        model = chain.model
+        state_size = chain.state_size
 
-    with open(sys.argv[1], 'r') as f:
-        corpus = f.read()
+    start = time.monotonic()
+    with open(args.corpus, 'r') as f:
+        model = train(f, state_size, args.workers, args.chunk_size, model)
+    print("trained {} states in {:.1f}s".format(len(model), time.monotonic() - start))
 
-    pasta_model = POSifiedText(corpus)
+    with open(args.model, 'w') as f:
+        f.write(Chain(None, state_size, model=model).to_json())
 
-    with open(sys.argv[2], 'w') as f:
-        f.write(pasta_model.chain.to_json())
+    if args.compiled:
+        with open(args.compiled, 'wb') as f:
+            write_compiled(model, state_size, f)
 
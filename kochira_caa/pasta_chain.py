@@ -0,0 +1,214 @@
+"""
+Compiled markov chains for pasta.
+
+A compiled chain is stored as flat arrays: an interned token table,
+integer-encoded states in sorted order, and for each state its next tokens
+with cumulative weights. Loading one memory-maps the file and samples by
+bisecting the arrays directly, instead of rebuilding markovify's dicts.
+
+Convert an existing JSON chain with:
+
+    python -m kochira_caa.pasta_chain pasta_model.json pasta_model.chain
+"""
+
+import bisect
+import json
+import mmap
+import random
+import struct
+import sys
+
+from array import array
+
+from markovify.chain import BEGIN, END
+
+MAGIC = b"PSTACHN1"
+HEADER_LENGTH = struct.Struct("<I")
+
+BEGIN_ID = 0
+END_ID = 1
+
+def _align(n):
+    return (n + 7) & ~7
+
+def _encode_token(token):
+    return token.encode("utf-8", "surrogatepass")
+
+def is_compiled(filename):
+    with open(filename, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+def write_compiled(model, state_size, f):
+    """
+    Write a markovify chain model (a dict of state tuples to dicts of next
+    token counts) to the binary file object ``f``.
+    """
+    tokens = {token for state in model for token in state}
+    tokens.update(token for nexts in model.values() for token in nexts)
+    tokens.discard(BEGIN)
+    tokens.discard(END)
+    tokens = [BEGIN, END] + sorted(tokens)
+    token_ids = {token: i for i, token in enumerate(tokens)}
+
+    base = len(tokens)
+    if base ** state_size >= 2 ** 63:
+        raise ValueError("too many tokens to encode states of size {}".format(state_size))
+
+    def encode_state(state):
+        key = 0
+        for token in state:
+            key = key * base + token_ids[token]
+        return key
+
+    states = sorted((encode_state(state), nexts) for state, nexts in model.items())
+
+    state_keys = array("q", (key for key, _ in states))
+    edge_offsets = array("q", [0])
+    edge_tokens = array("i")
+    edge_weights = array("q")
+
+    for _, nexts in states:
+        total = 0
+        for token, weight in nexts.items():
+            total += weight
+            edge_tokens.append(token_ids[token])
+            edge_weights.append(total)
+        edge_offsets.append(len(edge_tokens))
+
+    encoded_tokens = [_encode_token(token) for token in tokens]
+    token_offsets = array("q", [0])
+    for encoded in encoded_tokens:
+        token_offsets.append(token_offsets[-1] + len(encoded))
+    token_blob = array("B", b"".join(encoded_tokens))
+
+    sections = [
+        ("token_offsets", token_offsets),
+        ("token_blob", token_blob),
+        ("state_keys", state_keys),
+        ("edge_offsets", edge_offsets),
+        ("edge_tokens", edge_tokens),
+        ("edge_weights", edge_weights),
+    ]
+
+    layout = {}
+    offset = 0
+    for name, data in sections:
+        layout[name] = [offset, data.typecode, len(data)]
+        offset = _align(offset + len(data) * data.itemsize)
+
+    header = json.dumps({
+        "state_size": state_size,
+        "byteorder": sys.byteorder,
+        "sections": layout,
+    }).encode("utf-8")
+
+    f.write(MAGIC)
+    f.write(HEADER_LENGTH.pack(len(header)))
+    f.write(header)
+
+    position = len(MAGIC) + HEADER_LENGTH.size + len(header)
+    data_start = _align(position)
+
+    for name, data in sections:
+        start = data_start + layout[name][0]
+        f.write(b"\0" * (start - position))
+        data.tofile(f)
+        position = start + len(data) * data.itemsize
+
+class CompiledChain:
+    """
+    Read-only, memory-mapped markov chain.
+
+    Implements the parts of markovify's Chain interface that Text uses for
+    generating sentences.
+    """
+
+    def __init__(self, filename):
+        with open(filename, "rb") as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self.mmap[:len(MAGIC)] != MAGIC:
+            raise ValueError("{} is not a compiled chain".format(filename))
+
+        header_start = len(MAGIC) + HEADER_LENGTH.size
+        header_length, = HEADER_LENGTH.unpack_from(self.mmap, len(MAGIC))
+        header = json.loads(self.mmap[header_start:header_start + header_length].decode("utf-8"))
+
+        if header["byteorder"] != sys.byteorder:
+            raise ValueError("{} was compiled on a {}-endian machine".format(
+                filename, header["byteorder"]))
+
+        self.state_size = header["state_size"]
+        self._view = memoryview(self.mmap)
+        self._token_ids = None
+
+        data_start = _align(header_start + header_length)
+        for name, (offset, typecode, count) in header["sections"].items():
+            start = data_start + offset
+            end = start + count * array(typecode).itemsize
+            setattr(self, name, self._view[start:end].cast(typecode))
+
+        self.token_count = len(self.token_offsets) - 1
+
+    def token(self, token_id):
+        start = self.token_offsets[token_id]
+        end = self.token_offsets[token_id + 1]
+        return bytes(self.token_blob[start:end]).decode("utf-8", "surrogatepass")
+
+    def token_id(self, token):
+        if self._token_ids is None:
+            self._token_ids = {self.token(i): i for i in range(self.token_count)}
+        return self._token_ids[token]
+
+    def state_index(self, state_ids):
+        key = 0
+        for token_id in state_ids:
+            key = key * self.token_count + token_id
+
+        i = bisect.bisect_left(self.state_keys, key)
+        if i == len(self.state_keys) or self.state_keys[i] != key:
+            raise KeyError(state_ids)
+        return i
+
+    def move_id(self, state_ids):
+        i = self.state_index(state_ids)
+        lo = self.edge_offsets[i]
+        hi = self.edge_offsets[i + 1]
+
+        r = random.random() * self.edge_weights[hi - 1]
+        return self.edge_tokens[bisect.bisect(self.edge_weights, r, lo, hi)]
+
+    def move(self, state):
+        return self.token(self.move_id([self.token_id(token) for token in state]))
+
+    def gen(self, init_state=None):
+        if init_state is None:
+            state = [BEGIN_ID] * self.state_size
+        else:
+            state = [self.token_id(token) for token in init_state]
+
+        while True:
+            next_id = self.move_id(state)
+            if next_id == END_ID:
+                break
+            yield self.token(next_id)
+            state = state[1:] + [next_id]
+
+    def walk(self, init_state=None):
+        return list(self.gen(init_state))
+
+    def close(self):
+        for name in ("token_offsets", "token_blob", "state_keys",
+                     "edge_offsets", "edge_tokens", "edge_weights", "_view"):
+            getattr(self, name).release()
+        self.mmap.close()
+
+
+if __name__ == "__main__":
+    from markovify import Chain
+
+    with open(sys.argv[1], "r") as f:
+        chain = Chain.from_json(f.read())
+
+    with open(sys.argv[2], "wb") as f:
+        write_compiled(chain.model, chain.state_size, f)
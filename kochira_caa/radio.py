@@ -4,34 +4,142 @@ CAA r/a/dio.
 Like 4chan, except CAA.
 """
 
+import asyncio
+import logging
+from hashlib import sha1
+from io import BytesIO
+
 from kochira import config
 from kochira.auth import requires_permission
 from kochira.service import Service, Config
-from lxml import etree
 
 service = Service(__name__, __doc__)
 
+logger = logging.getLogger(__name__)
+
 @service.config
 class Config(Config):
+    class Announce(Config):
+        network = config.Field(doc="Network to announce on.")
+        channel = config.Field(doc="Channel to announce in.")
+
     username = config.Field(doc="Username for HTTP basic auth.")
     password = config.Field(doc="Password for HTTP basic auth.")
     url = config.Field(doc="URL of the Icecast2 admin page.")
     mount = config.Field(doc="Name of the Icecast2 mountpoint.")
+    poll_interval = config.Field(doc="Seconds between refreshes of what's playing.", default=15)
+    announce = config.Field(doc="Channels to announce track changes in.", type=config.Many(Announce), default=[])
+
+# sentinel for before the first successful refresh
+UNKNOWN = object()
+
+_track_xpath = None
+
+def get_track_xpath():
+    """
+    XPath pulling (artist, title) out of the source element for a mount,
+    compiled once and evaluated against each source as it is parsed.
+    """
+    global _track_xpath
+
+    if _track_xpath is None:
+        from lxml import etree
+        _track_xpath = etree.XPath("self::source[@mount=$mount]/*[self::artist or self::title]")
+    return _track_xpath
 
-async def _np(ctx):
+def parse_np(content, mount):
+    from lxml import etree
+
+    track = get_track_xpath()
+
+    for _, source in etree.iterparse(BytesIO(content), tag="source"):
+        fields = track(source, mount=mount)
+        if fields or source.get("mount") == mount:
+            np = {field.tag: field.text or "" for field in fields}
+            return (np.get("artist", ""), np.get("title", ""))
+
+        # throw away every other mount as we go
+        source.clear()
+        while source.getprevious() is not None:
+            del source.getparent()[0]
+
+    return None
+
+async def refresh(ctx):
+    """
+    Fetch the admin page, only parsing it again if it has changed since the
+    last refresh. Returns whether what's playing changed.
+    """
     config = ctx.config
-    mount = config.mount
-    r = etree.fromstring((await ctx.bot.http.get(
-        config.url, auth=(config.username, config.password)
-    )).content)
+    storage = ctx.storage
+
+    headers = {}
+    if storage.etag is not None:
+        headers["If-None-Match"] = storage.etag
+    if storage.last_modified is not None:
+        headers["If-Modified-Since"] = storage.last_modified
 
-    mount_exists = bool(r.xpath("source[@mount='{}']".format(mount)))
-    artist = r.xpath("source[@mount='{}']/artist/text()".format(mount))
-    title = r.xpath("source[@mount='{}']/title/text()".format(mount))
+    r = await ctx.bot.http.get(config.url, auth=(config.username, config.password), headers=headers)
+    if r.status_code == 304:
+        return False
+    r.raise_for_status()
 
-    if not mount_exists:
-        return None
-    return (artist[0] if artist else "", title[0] if title else "")
+    storage.etag = r.headers.get("ETag")
+    storage.last_modified = r.headers.get("Last-Modified")
+
+    # icecast doesn't send validators for its admin pages, so also skip
+    # parsing when the page is byte for byte the same
+    digest = sha1(r.content).digest()
+    if digest == storage.digest:
+        return False
+    storage.digest = digest
+
+    np = parse_np(r.content, config.mount)
+    if np == storage.np:
+        return False
+
+    storage.np = np
+    return True
+
+def format_np(np):
+    if not np:
+        return "\x02Now playing:\x02 Nothing!"
+    elif np == ("", ""):
+        return "\x02Now playing:\x02 No metadata available!"
+    else:
+        return "\x02Now playing:\x02 {}".format(" - ".join(np))
+
+async def announce(ctx):
+    for target in ctx.config.announce:
+        client = ctx.bot.clients.get(target.network)
+        if client is not None:
+            await client.message(target.channel, format_np(ctx.storage.np))
+
+async def poll(ctx):
+    while True:
+        first = ctx.storage.np is UNKNOWN
+
+        try:
+            if await refresh(ctx) and not first and ctx.storage.np:
+                await announce(ctx)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Couldn't refresh now playing")
+
+        await asyncio.sleep(ctx.config.poll_interval)
+
+@service.setup
+def start_poller(ctx):
+    ctx.storage.np = UNKNOWN
+    ctx.storage.etag = None
+    ctx.storage.last_modified = None
+    ctx.storage.digest = None
+    ctx.storage.poller = asyncio.ensure_future(poll(ctx))
+
+@service.shutdown
+def stop_poller(ctx):
+    ctx.storage.poller.cancel()
 
 @service.command(r"^\.np$")
 @requires_permission("caa_radio")
@@ -41,10 +149,7 @@ async def now_playing(ctx):
 
     Gets the metadata of the currently playing song.
     """
-    np = await _np(ctx)
-    if not np:
-        await ctx.message("\x02Now playing:\x02 Nothing!")
-    elif np == ("", ""):
-        await ctx.message("\x02Now playing:\x02 No metadata available!")
-    else:
-        await ctx.message("\x02Now playing:\x02 {}".format(" - ".join(np)))
+    if ctx.storage.np is UNKNOWN:
+        await refresh(ctx)
+
+    await ctx.message(format_np(ctx.storage.np))
@@ -0,0 +1,99 @@
+"""
+Text transforms shared by the silly text commands.
+
+Output is built up as a list and joined once, and random numbers are drawn
+in a single batch per call, so that pasted walls of text stay cheap.
+"""
+
+import random
+import re
+
+from functools import lru_cache
+
+IMOUTO_WORD_RE = re.compile(r"\w\w\w\w\w+")
+STEM_CACHE_SIZE = 8192
+
+# chance that spongebob keeps the same case after a run of n characters,
+# scaled to 16-bit random numbers. Once the chance rounds down to nothing,
+# -1 makes sure the case always flips, so runs never outgrow the table.
+SPONGEBOB_KEEP = [int(65536 * 0.75 ** (run * 1.5)) or -1 for run in range(64)]
+
+_stemmer = None
+
+def random_bytes(n):
+    """
+    Return n random bytes from a single call into the random module.
+    """
+    if not n:
+        return b""
+    return random.getrandbits(8 * n).to_bytes(n, "little")
+
+def nichi(text):
+    rand = random_bytes(3 * len(text))
+    out = []
+
+    for i, c in enumerate(text):
+        j = 3 * i
+        # 102/256 ~ 0.4, 77/256 ~ 0.3
+        if rand[j] < 102:
+            if rand[j + 1] < 77:
+                out.append(',' * (3 + rand[j + 2] % 4))
+            else:
+                out.append(',' * (1 + rand[j + 2] % 2))
+        out.append(c)
+
+    return "".join(out)
+
+def spongebob(text):
+    rand = memoryview(random_bytes(2 * len(text) + 2)).cast("H")
+    upper = rand[-1] < 32768
+    keep = SPONGEBOB_KEEP
+    out = []
+
+    start = 0
+    run_length = 1
+    for i, r in enumerate(rand[:-1]):
+        if r > keep[run_length]:
+            segment = text[start:i + 1]
+            out.append(segment.upper() if upper else segment.lower())
+            upper = not upper
+            start = i + 1
+            run_length = 1
+        else:
+            run_length += 1
+
+    segment = text[start:]
+    out.append(segment.upper() if upper else segment.lower())
+    return "".join(out)
+
+def get_stemmer():
+    global _stemmer
+
+    if _stemmer is None:
+        from nltk.stem.snowball import SnowballStemmer
+        _stemmer = SnowballStemmer('english')
+    return _stemmer
+
+@lru_cache(maxsize=STEM_CACHE_SIZE)
+def stem(word):
+    return get_stemmer().stem(word)
+
+def case_corrected_imouto(word, imouto):
+    if all(c.isupper() for c in word):
+        return imouto.upper()
+
+    if word.capitalize() == word:
+        return imouto.capitalize()
+
+    return imouto
+
+def imouto(text, imouto):
+    def stemmed_imouto(match):
+        word = match.group(0)
+        word_stem = stem(word)
+        if word != word_stem and word.startswith(word_stem):
+            return case_corrected_imouto(word, imouto) + word[len(word_stem):]
+        else:
+            return case_corrected_imouto(word, imouto)
+
+    return IMOUTO_WORD_RE.sub(stemmed_imouto, text)
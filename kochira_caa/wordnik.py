@@ -4,28 +4,149 @@ Wordnik API.
 For when you want to do terrible things with words.
 """
 
+import asyncio
+import json
+import logging
+import os
+from collections import deque
+
 from kochira import config
 from kochira.service import Service, Config
 
 service = Service(__name__, __doc__)
 
+logger = logging.getLogger(__name__)
+
+PARTS_OF_SPEECH = ['adjective', 'noun', 'verb-transitive']
+
 @service.config
 class Config(Config):
     api_key = config.Field(doc="Wordnik API key")
+    low_watermark = config.Field(doc="Refill a part of speech once it has this many words left.", default=5)
+    high_watermark = config.Field(doc="Number of words to keep on hand for each part of speech.", default=50)
+    snapshot_file = config.Field(doc="Where to save unused words between restarts.", default="wordnik_words.json")
+
+class WordReservoir:
+    """
+    Random words fetched ahead of time, per part of speech.
+
+    Once a part of speech drops to ``low_watermark`` words, it is topped back
+    up to ``high_watermark`` in the background with a single bulk request. If
+    one runs dry, a word is fetched on the spot instead.
+    """
+
+    def __init__(self, get_word, get_words, low_watermark, high_watermark, snapshot_file=None):
+        self.get_word = get_word
+        self.get_words = get_words
+        self.low_watermark = low_watermark
+        self.high_watermark = high_watermark
+        self.snapshot_file = snapshot_file
+
+        self.words = {}
+        self.refills = {}
+
+        self.hits = 0
+        self.misses = 0
+
+    def load(self):
+        if self.snapshot_file is None or not os.path.exists(self.snapshot_file):
+            return
+
+        try:
+            with open(self.snapshot_file, 'r') as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError):
+            logger.exception("Couldn't load word snapshot")
+            return
+
+        for part_of_speech, words in snapshot.items():
+            self.words[part_of_speech] = deque(words)
+
+    def save(self):
+        if self.snapshot_file is None:
+            return
+
+        snapshot = {part_of_speech: list(words) for part_of_speech, words in self.words.items()}
+
+        temp_file = self.snapshot_file + ".tmp"
+        with open(temp_file, 'w') as f:
+            json.dump(snapshot, f)
+        os.replace(temp_file, self.snapshot_file)
+
+    def refill(self, part_of_speech):
+        task = self.refills.get(part_of_speech)
+        if task is None or task.done():
+            self.refills[part_of_speech] = asyncio.ensure_future(self._refill(part_of_speech))
+
+    async def _refill(self, part_of_speech):
+        words = self.words.setdefault(part_of_speech, deque())
+        wanted = self.high_watermark - len(words)
+        if wanted <= 0:
+            return
+
+        try:
+            words.extend(await self.get_words(part_of_speech, wanted))
+            self.save()
+        except Exception:
+            logger.exception("Couldn't refill %s", part_of_speech)
+
+    async def get(self, part_of_speech):
+        words = self.words.get(part_of_speech)
+
+        if words:
+            self.hits += 1
+            word = words.popleft()
+        else:
+            self.misses += 1
+            word = None
+
+        if words is None or len(words) <= self.low_watermark:
+            self.refill(part_of_speech)
+
+        if word is None:
+            word = await self.get_word(part_of_speech)
+        return word
+
+    async def get_many(self, *parts_of_speech):
+        return await asyncio.gather(*[self.get(part_of_speech) for part_of_speech in parts_of_speech])
+
+    def stop(self):
+        for task in self.refills.values():
+            task.cancel()
+        self.save()
 
 @service.setup
 def make_api(ctx):
-    async def wordnik_get_word(part_of_speech, min_corpus_count=1000):
-        r = await ctx.bot.http.get("https://api.wordnik.com/v4/words.json/randomWord", params={
-            'hasDictionaryDef': 'true',
-            'includePartOfSpeech': part_of_speech,
-            'minCorpusCount': min_corpus_count,
-            'minLength': 5,
-            'api_key': ctx.config.api_key,
-        })
+    params = {
+        'hasDictionaryDef': 'true',
+        'minCorpusCount': 1000,
+        'minLength': 5,
+        'api_key': ctx.config.api_key,
+    }
+
+    async def wordnik_get_word(part_of_speech):
+        r = await ctx.bot.http.get("https://api.wordnik.com/v4/words.json/randomWord", params=dict(
+            params, includePartOfSpeech=part_of_speech))
         return r.json()['word']
 
-    ctx.storage.get_word = wordnik_get_word
+    async def wordnik_get_words(part_of_speech, limit):
+        r = await ctx.bot.http.get("https://api.wordnik.com/v4/words.json/randomWords", params=dict(
+            params, includePartOfSpeech=part_of_speech, limit=limit))
+        r.raise_for_status()
+        return [word['word'] for word in r.json()]
+
+    ctx.storage.words = WordReservoir(wordnik_get_word, wordnik_get_words,
+                                      ctx.config.low_watermark, ctx.config.high_watermark,
+                                      ctx.config.snapshot_file)
+    ctx.storage.words.load()
+
+    for part_of_speech in PARTS_OF_SPEECH:
+        if len(ctx.storage.words.words.get(part_of_speech, ())) <= ctx.config.low_watermark:
+            ctx.storage.words.refill(part_of_speech)
+
+@service.shutdown
+def save_words(ctx):
+    ctx.storage.words.stop()
 
 @service.command(r"^:amatsukaze:$")
 async def amatsukaze(ctx):
@@ -34,8 +155,7 @@ async def amatsukaze(ctx):
 
     That's surely very advanced for computers.
     """
-    adjective = await ctx.storage.get_word('adjective')
-    noun = await ctx.storage.get_word('noun')
+    adjective, noun = await ctx.storage.words.get_many('adjective', 'noun')
 
     await ctx.message("That's surely very {adjective} for {noun}.".format(
         adjective=adjective,
@@ -49,8 +169,7 @@ async def szi(ctx):
 
     <szi> Choose this, whips out axiom of choice
     """
-    verb = await ctx.storage.get_word('verb-transitive')
-    noun = await ctx.storage.get_word('noun')
+    verb, noun = await ctx.storage.words.get_many('verb-transitive', 'noun')
 
     await ctx.message("<szi> {verb} this, whips out {noun}".format(
         verb=verb,
@@ -64,8 +183,22 @@ async def szi_partial(ctx):
 
     <szi> bring this <szi> whips out your deliverance from a startup that won't make money
     """
-    noun = await ctx.storage.get_word('noun')
+    noun = await ctx.storage.words.get('noun')
 
     await ctx.message("whips out {noun}".format(
         noun=noun
     ))
+
+@service.command(r"!wordnikstats$")
+async def wordnik_stats(ctx):
+    """
+    Wordnik stats.
+
+    Show how well the word reservoir is keeping up.
+    """
+    words = ctx.storage.words
+    await ctx.message("\x02words:\x02 {ready}, hits: {w.hits}, misses: {w.misses}".format(
+        ready=", ".join("{} {}".format(part_of_speech, len(words.words.get(part_of_speech, ())))
+                        for part_of_speech in PARTS_OF_SPEECH),
+        w=words,
+    ))
@@ -0,0 +1,113 @@
+import asyncio
+from collections import deque
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("kochira")
+pytest.importorskip("google.genai")
+
+from kochira_caa import gemma
+
+USAGE = SimpleNamespace(total_token_count=42, prompt_token_count=30, thoughts_token_count=2)
+
+
+class FakeModels:
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.calls = 0
+
+    async def generate_content_stream(self, **kwargs):
+        self.calls += 1
+
+        async def stream():
+            for text in self.chunks:
+                await asyncio.sleep(0)
+                yield SimpleNamespace(text=text, usage_metadata=None)
+            yield SimpleNamespace(text=None, usage_metadata=USAGE)
+
+        return stream()
+
+
+class FakeContext:
+    def __init__(self, models, origin="alice", backlog=None):
+        if backlog is None:
+            backlog = deque([(origin, "big dog hi")], maxlen=10)
+
+        self.origin = origin
+        self.target = "#channel"
+        self.client = SimpleNamespace(name="network", nickname="bot", backlogs={"#channel": backlog})
+        self.config = SimpleNamespace(
+            backlog_window=None,
+            history_token_budget=2000,
+            response_cache_context_lines=3,
+            stream_responses=True,
+        )
+        self.storage = SimpleNamespace(
+            gemini=SimpleNamespace(aio=SimpleNamespace(models=models)),
+            quota=gemma.QuotaLedger(-1, 1000, 60),
+            transcripts={},
+            prompt_stats=gemma.PromptStats(),
+            cache=gemma.ResponseCache(0, 600),
+            scheduler=gemma.RequestScheduler(4, 1, 8),
+        )
+        self.sent = []
+
+    async def respond(self, text):
+        self.sent.append(("respond", text))
+
+    async def message(self, text):
+        self.sent.append(("message", text))
+
+
+def ask(ctx, text="hi"):
+    return gemma.respond(ctx, "Big Dog", text, "instructions", "minimal")
+
+
+def test_streams_at_most_three_lines():
+    ctx = FakeContext(FakeModels(["one\ntw", "o\n\nthree\nfour\n", "five"]))
+    asyncio.run(ask(ctx))
+
+    assert ctx.sent == [("respond", "one"), ("message", "two"), ("message", "three")]
+
+
+def test_first_line_addressed_to_asker_is_sent_as_is():
+    ctx = FakeContext(FakeModels(["alice: you again\n", "bye"]))
+    asyncio.run(ask(ctx))
+
+    assert ctx.sent == [("message", "alice: you again"), ("message", "bye")]
+
+
+def test_coalesced_caller_gets_joined_text():
+    models = FakeModels(["one\n", "two\n", "three\n", "four"])
+    backlog = deque([("alice", "big dog what is up")], maxlen=10)
+    first = FakeContext(models, backlog=backlog)
+    second = FakeContext(models, origin="bob", backlog=backlog)
+    second.storage = first.storage
+
+    async def both():
+        asking = asyncio.ensure_future(ask(first, " what is up"))
+        await asyncio.sleep(0)
+
+        # the repeated question lands in the backlog while the first is
+        # still being answered
+        backlog.appendleft(("bob", "big dog What is up?"))
+        await ask(second, " What is up?")
+        await asking
+
+    asyncio.run(both())
+
+    assert models.calls == 1
+    assert first.storage.scheduler.coalesced == 1
+    assert first.sent == [("respond", "one"), ("message", "two"), ("message", "three")]
+    assert second.sent == [("respond", "one\ntwo\nthree")]
+
+
+def test_time_to_first_line_is_recorded():
+    ctx = FakeContext(FakeModels(["hello\n", "world"]))
+    asyncio.run(ask(ctx))
+
+    scheduler = ctx.storage.scheduler
+    assert scheduler.streams == 1
+    assert scheduler.last_first_line_ms > 0
+    assert scheduler.total_first_line_ms == scheduler.last_first_line_ms
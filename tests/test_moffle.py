@@ -0,0 +1,173 @@
+import asyncio
+import hmac
+import json
+from base64 import urlsafe_b64encode
+from hashlib import sha256
+from types import SimpleNamespace
+from urllib.parse import unquote
+
+import pytest
+
+pytest.importorskip("kochira")
+httpx = pytest.importorskip("httpx")
+
+from tornado.httpserver import HTTPServer
+from tornado.testing import bind_unused_port
+from tornado.web import Application, RequestHandler
+
+from kochira_caa import moffle
+
+API_KEY = "secret"
+
+DATES = {
+    "old": "2019-03-01",
+    "new": "2021-07-15",
+    "newest": "2023-01-02",
+}
+
+
+def result(date):
+    return {
+        "total_results": 2,
+        "canonical_url": "/search?q=x",
+        "results": [
+            None,
+            {
+                "date": date,
+                "lines": [
+                    {"line": "before", "line_marker": "-"},
+                    {"line": "match from " + date, "line_marker": ":"},
+                    {"line": "after", "line_marker": "-"},
+                ],
+            },
+        ],
+    }
+
+
+class SearchHandler(RequestHandler):
+    def initialize(self, hits):
+        self.hits = hits
+
+    async def get(self, name, network, channel):
+        self.hits[name] = self.hits.get(name, 0) + 1
+
+        args = {k: self.get_argument(k) for k in self.request.arguments if k != "sig"}
+        path = "/api/search/{}/{}".format(unquote(network), unquote(channel)).encode("utf_8") + b"?"
+        m = hmac.new(API_KEY.encode("utf_8"), digestmod=sha256)
+        m.update(path)
+        m.update("&".join(sorted("{}={}".format(k, v) for k, v in args.items())).encode("utf_8"))
+        if self.get_argument("sig") != urlsafe_b64encode(m.digest()).decode("ascii"):
+            self.set_status(403)
+            return
+
+        if name == "slow":
+            await asyncio.sleep(1)
+
+        self.write(json.dumps(result(DATES[name])))
+
+
+def run(test, instances, timeout=0.5, cache_ttl=60):
+    """
+    Run the coroutine function ``test`` with a context whose instances are
+    served by a local stub moffle server.
+    """
+    async def main():
+        hits = {}
+        sock, port = bind_unused_port()
+        server = HTTPServer(Application([
+            (r"/(\w+)/api/search/([^/]+)/([^/]+)", SearchHandler, {"hits": hits}),
+        ]))
+        server.add_sockets([sock])
+
+        sent = []
+
+        async def send(text):
+            sent.append(text)
+
+        async with httpx.AsyncClient() as http:
+            ctx = SimpleNamespace(
+                bot=SimpleNamespace(http=http),
+                client=SimpleNamespace(name="Network"),
+                target="#Channel",
+                respond=send,
+                message=send,
+                storage=SimpleNamespace(),
+                config=SimpleNamespace(
+                    instances={
+                        name: SimpleNamespace(base_url="http://127.0.0.1:{}/{}/".format(port, name),
+                                              api_uid="1", api_key=API_KEY)
+                        for name in instances
+                    },
+                    timeout=timeout,
+                    cache_ttl=cache_ttl,
+                ),
+            )
+            moffle.initialize_cache(ctx)
+
+            try:
+                await test(ctx)
+            finally:
+                server.stop()
+
+        return sent, hits
+
+    return asyncio.run(main())
+
+
+def test_search_all_merges_by_date_and_skips_timeouts():
+    async def test(ctx):
+        await moffle.search(ctx, "all", "x")
+
+    sent, hits = run(test, ["old", "newest", "slow", "new"], timeout=0.2)
+
+    assert hits == {"old": 1, "newest": 1, "slow": 1, "new": 1}
+    assert sent[0] == "before\nmatch from 2023-01-02\nafter"
+    assert sent[1].startswith("\x02Log from:\x02 2023-01-02.")
+    assert sent[2] == "\x02Also in:\x02 new (2021-07-15, 2 results), old (2019-03-01, 2 results)"
+    assert len(sent) == 3
+
+
+def test_search_all_with_every_instance_timing_out():
+    async def test(ctx):
+        await moffle.search(ctx, "all", "x")
+
+    sent, _ = run(test, ["slow"], timeout=0.1)
+
+    assert sent == ["No results found for \"x\" anywhere!"]
+
+
+def test_signer_is_reused():
+    async def test(ctx):
+        signer = moffle.get_signer(ctx, API_KEY)
+        assert moffle.get_signer(ctx, API_KEY) is signer
+
+        # copies of the cached signer have to keep producing valid signatures
+        await moffle.search(ctx, "old", "x")
+        await moffle.search(ctx, "old", "y")
+        assert moffle.get_signer(ctx, API_KEY) is signer
+        assert len(ctx.storage.signers) == 1
+
+    sent, hits = run(test, ["old"])
+
+    assert hits == {"old": 2}
+    assert sent[0] == sent[2] == "before\nmatch from 2019-03-01\nafter"
+
+
+def test_cached_search_reuses_results_within_ttl():
+    async def test(ctx):
+        first = await moffle.cached_search(ctx, "new", "x")
+        second = await moffle.cached_search(ctx, "new", "x")
+        assert first == second
+        await moffle.cached_search(ctx, "new", "other")
+
+    _, hits = run(test, ["new"])
+    assert hits == {"new": 2}
+
+
+def test_cached_search_expires():
+    async def test(ctx):
+        await moffle.cached_search(ctx, "new", "x")
+        await moffle.cached_search(ctx, "new", "x")
+
+    _, hits = run(test, ["new"], cache_ttl=0)
+    assert hits == {"new": 2}
@@ -0,0 +1,88 @@
+import subprocess
+import sys
+import os
+
+import pytest
+
+pytest.importorskip("kochira")
+pytest.importorskip("markovify")
+
+from markovify import Chain
+from markovify.chain import BEGIN, END
+
+from kochira_caa.pasta import PastaText
+from kochira_caa.pasta_chain import write_compiled
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+MODEL = {
+    (BEGIN, BEGIN): {"good::JJ": 2, "bad::JJ": 1},
+    (BEGIN, "good::JJ"): {"memes::NNS": 1},
+    (BEGIN, "bad::JJ"): {"memes::NNS": 1},
+    ("good::JJ", "memes::NNS"): {"go::VBP": 1, END: 1},
+    ("bad::JJ", "memes::NNS"): {END: 1},
+    ("memes::NNS", "go::VBP"): {END: 1},
+}
+
+GENERATE = """
+import sys
+sys.path.insert(0, {root!r})
+
+from markovify import Chain
+from kochira_caa.pasta import PastaText
+from kochira_caa.pasta_chain import CompiledChain
+
+with open({json_path!r}) as f:
+    chains = [Chain.from_json(f.read()), CompiledChain({compiled_path!r})]
+
+for chain in chains:
+    model = PastaText(chain)
+    for _ in range(20):
+        assert model.make_sentence() is not None
+
+print("nltk.tag" in sys.modules)
+"""
+
+
+@pytest.fixture
+def model_files(tmp_path):
+    json_path = tmp_path / "model.json"
+    json_path.write_text(Chain(None, 2, model=MODEL).to_json())
+
+    compiled_path = tmp_path / "model.chain"
+    with open(compiled_path, "wb") as f:
+        write_compiled(MODEL, 2, f)
+
+    return str(json_path), str(compiled_path)
+
+
+def test_generating_never_imports_tagger(model_files):
+    json_path, compiled_path = model_files
+
+    # a fresh interpreter, so nothing else in the test run has imported nltk
+    result = subprocess.run(
+        [sys.executable, "-c", GENERATE.format(root=ROOT, json_path=json_path, compiled_path=compiled_path)],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+
+    assert result.stdout.strip() == "False"
+
+
+def test_sentences_are_untagged(model_files):
+    json_path, _ = model_files
+
+    with open(json_path) as f:
+        model = PastaText(Chain.from_json(f.read()))
+
+    for _ in range(20):
+        sentence = model.make_sentence()
+        assert sentence in ("good memes", "good memes go", "bad memes")
+
+
+def test_word_split_refuses_to_tag(model_files):
+    json_path, _ = model_files
+
+    with open(json_path) as f:
+        model = PastaText(Chain.from_json(f.read()))
+
+    with pytest.raises(RuntimeError):
+        model.word_split("good memes")